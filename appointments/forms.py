@@ -9,6 +9,7 @@ from django.utils.encoding import force_unicode
 from django.utils.translation import ugettext_lazy as _
 
 from .models import Timeline, TimelineSubscription, Appointment, Notification, now
+from .models import get_timeline_for_keyword
 
 
 class PlainErrorList(ErrorList):
@@ -29,16 +30,20 @@ class HandlerForm(forms.Form):
         kwargs['error_class'] = PlainErrorList
         super(HandlerForm, self).__init__(*args, **kwargs)
 
+    def get_subscription(self, timeline, name):
+        "Active subscription of this connection to the timeline with the given pin or None."
+        subscriptions = TimelineSubscription.objects.filter(
+            Q(Q(end__gte=now()) | Q(end__isnull=True)),
+            timeline=timeline, connection=self.connection, pin=name
+        ).order_by('-start')[:1]
+        return subscriptions[0] if subscriptions else None
+
     def clean_keyword(self):
         "Check if this keyword is associated with any timeline."
         keyword = self.cleaned_data.get('keyword', '')
         match = None
         if keyword:
-            # Query DB for valid keywords
-            for timeline in Timeline.objects.filter(slug__icontains=keyword):
-                if keyword.strip().lower() in timeline.keywords:
-                    match = timeline
-                    break
+            match = get_timeline_for_keyword(keyword)
         if match is None:
             # Invalid keyword
             raise forms.ValidationError(_('Sorry, we could not find any appointments for '
@@ -78,35 +83,23 @@ class NewForm(HandlerForm):
             'For the best results please use the ISO YYYY-MM-DD format.')
     })
 
-    def clean(self):
-        "Check for previous subscription."
-        timeline = self.cleaned_data.get('timeline', None)
-        name = self.cleaned_data.get('name', None)
-        if name is not None and timeline is not None:
-            previous = TimelineSubscription.objects.filter(
-                Q(Q(end__isnull=True) | Q(end__gte=now())),
-                timeline=timeline, connection=self.connection, pin=name
-            )
-            if previous.exists():
-                params = {'timeline': timeline.name, 'name': name}
-                message = _('Sorry, you previously registered a %(timeline)s for '
-                        '%(name)s. You will be notified when '
-                        'it is time for the next appointment.') % params
-                raise forms.ValidationError(message)
-        return self.cleaned_data
-
     def save(self):
         if not self.is_valid():
             return None
         timeline = self.cleaned_data['timeline']
         name = self.cleaned_data['name']
         start = self.cleaned_data.get('date', now()) or now()
-        # FIXME: There is a small race condition here that we could
-        # create two subscriptions in parallel
-        TimelineSubscription.objects.create(
+        subscription = TimelineSubscription(
             timeline=timeline, start=start, pin=name,
             connection=self.connection
         )
+        if not subscription.insert_unless_active():
+            params = {'timeline': timeline.name, 'name': name}
+            message = _('Sorry, you previously registered a %(timeline)s for '
+                    '%(name)s. You will be notified when '
+                    'it is time for the next appointment.') % params
+            self._errors[NON_FIELD_ERRORS] = self.error_class([message])
+            return None
         user = ' %s' % self.connection.contact.name if self.connection.contact else ''
         return {
             'user': user,
@@ -126,13 +119,11 @@ class ConfirmForm(HandlerForm):
         timeline = self.cleaned_data.get('timeline', None)
         name = self.cleaned_data.get('name', '')
         # name should be a pin for an active timeline subscription
-        timelines = TimelineSubscription.objects.filter(
-            Q(Q(end__gte=now()) | Q(end__isnull=True)),
-            timeline=timeline, connection=self.connection, pin=name
-        ).values_list('timeline', flat=True)
-        if not timelines:
+        subscription = self.get_subscription(timeline, name)
+        if subscription is None:
             # PIN doesn't match an active subscription for this connection
             raise forms.ValidationError(_('Sorry, name/id does not match an active subscription.'))
+        self.cleaned_data['subscription'] = subscription
         try:
             notification = Notification.objects.filter(
                 status=Notification.STATUS_SENT,
@@ -140,7 +131,7 @@ class ConfirmForm(HandlerForm):
                 appointment__confirmed__isnull=True,
                 appointment__reschedule__isnull=True,
                 appointment__date__gte=now(),
-                appointment__milestone__timeline__in=timelines
+                appointment__subscription=subscription,
             ).order_by('-sent')[0]
         except IndexError:
             # No unconfirmed notifications
@@ -181,18 +172,16 @@ class StatusForm(HandlerForm):
         timeline = self.cleaned_data.get('timeline', None)
         name = self.cleaned_data.get('name', '')
         # name should be a pin for an active timeline subscription
-        timelines = TimelineSubscription.objects.filter(
-            Q(Q(end__gte=now()) | Q(end__isnull=True)),
-            timeline=timeline, connection=self.connection, pin=name
-        ).values_list('timeline', flat=True)
-        if not timelines:
+        subscription = self.get_subscription(timeline, name)
+        if subscription is None:
             # PIN doesn't match an active subscription for this connection
             raise forms.ValidationError(_('Sorry, name/id does not match an active subscription.'))
+        self.cleaned_data['subscription'] = subscription
         try:
             appointment = Appointment.objects.filter(
                 status=Appointment.STATUS_DEFAULT,
                 date__lte=now(),
-                milestone__timeline__in=timelines
+                subscription=subscription,
             ).order_by('-date')[0]
         except IndexError:
             # No recent appointment that is not STATUS_DEFAULT
@@ -235,18 +224,16 @@ class MoveForm(HandlerForm):
         timeline = self.cleaned_data.get('timeline', None)
         name = self.cleaned_data.get('name', '')
         # name should be a pin for an active timeline subscription
-        timelines = TimelineSubscription.objects.filter(
-            Q(Q(end__gte=now()) | Q(end__isnull=True)),
-            timeline=timeline, connection=self.connection, pin=name
-        ).values_list('timeline', flat=True)
-        if not timelines:
+        subscription = self.get_subscription(timeline, name)
+        if subscription is None:
             # PIN doesn't match an active subscription for this connection
             raise forms.ValidationError(_('Sorry, name/id does not match an active subscription.'))
+        self.cleaned_data['subscription'] = subscription
         try:
             appointment = Appointment.objects.filter(
                 status=Appointment.STATUS_DEFAULT,
                 date__gte=now(),
-                milestone__timeline__in=timelines,
+                subscription=subscription,
                 reschedule__isnull=True,
                 appointments__isnull=True,
             ).order_by('-date')[0]
@@ -258,6 +245,21 @@ class MoveForm(HandlerForm):
             self.cleaned_data['appointment'] = appointment
         return name
 
+    def clean(self):
+        "Check the milestone doesn't already have an appointment on the new date."
+        appointment = self.cleaned_data.get('appointment', None)
+        date = self.cleaned_data.get('date', None)
+        if appointment is not None and date is not None:
+            scheduled = Appointment.objects.filter(
+                subscription=appointment.subscription_id,
+                milestone=appointment.milestone_id,
+                date=date.date(),
+            )
+            if scheduled.exists():
+                raise forms.ValidationError(_('Sorry, the appointment is already scheduled '
+                    'for %s.') % date.date().isoformat())
+        return self.cleaned_data
+
     def save(self):
         "Mark the appointment status and return it"
         if not self.is_valid():
@@ -289,24 +291,6 @@ class QuitForm(HandlerForm):
             'For the best results please use the ISO YYYY-MM-DD format.')
     })
 
-    def clean_keyword(self):
-        "Check if this keyword is associated with any timeline."
-        keyword = self.cleaned_data.get('keyword', '')
-        match = None
-        if keyword:
-            # Query DB for valid keywords
-            for timeline in Timeline.objects.filter(slug__icontains=keyword):
-                if keyword.strip().lower() in timeline.keywords:
-                    match = timeline
-                    break
-        if match is None:
-            # Invalid keyword
-            raise forms.ValidationError(_('Sorry, we could not find any appointments for '
-                    'the keyword: %s') % keyword)
-        else:
-            self.cleaned_data['timeline'] = match
-        return keyword
-
     def clean(self):
         "Check for previous subscription."
         timeline = self.cleaned_data.get('timeline', None)
@@ -376,8 +360,12 @@ class AppointmentFilterForm(forms.Form):
             confirmed = False if confirmed == 'false' else True
         return confirmed
 
+    # Lookups on the appointment's own copy of related fields
+    lookups = {'subscription__timeline': 'timeline'}
+
     def get_items(self):
         if self.is_valid():
-            filters = dict([(k, v) for k, v in self.cleaned_data.iteritems() if v or v is False])
+            filters = dict([(self.lookups.get(k, k), v)
+                            for k, v in self.cleaned_data.iteritems() if v or v is False])
             return Appointment.objects.filter(**filters)
         return Appointment.objects.none()
@@ -26,8 +26,9 @@ class AppointmentHandler(KeywordHandler):
         "Parse text, validate data, and respond."
         parsed = self.parse_message(text)
         form = self.form(data=parsed, connection=self.msg.connection)
-        if form.is_valid():
-            params = form.save()
+        # Forms may still add errors while saving, e.g. on a conflicting write
+        params = form.save() if form.is_valid() else None
+        if params is not None:
             self.respond(self.success_text % params)
         else:
             error = form.error()
@@ -0,0 +1,20 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ...tasks import generate_appointments
+
+
+class Command(BaseCommand):
+    help = 'Create the upcoming appointments for all active timeline subscriptions.'
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', dest='days', default=14,
+            help='The number of upcoming days to create appointments for.'),
+        make_option('--rebuild', action='store_true', dest='rebuild', default=False,
+            help='Compute the full window, ignoring the dates generated by previous runs.'),
+    )
+
+    def handle(self, *args, **options):
+        counts = generate_appointments(days=options['days'], rebuild=options['rebuild'])
+        self.stdout.write('Scanned %(scanned)s subscription(s) and created '
+            '%(created)s appointment(s).' % counts)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import DataMigration
+from django.db import models
+from django.db.models import Count, Min
+
+class Migration(DataMigration):
+
+    def forwards(self, orm):
+        "Merge appointments with the same subscription, milestone and date into the oldest."
+        Appointment = orm['appointments.Appointment']
+        duplicates = Appointment.objects.values('subscription', 'milestone', 'date').annotate(
+            count=Count('id'), first=Min('id')).filter(count__gt=1)
+        for duplicate in duplicates:
+            others = Appointment.objects.filter(
+                subscription=duplicate['subscription'], milestone=duplicate['milestone'],
+                date=duplicate['date']).exclude(pk=duplicate['first'])
+            others = list(others.values_list('id', flat=True))
+            orm['appointments.Notification'].objects.filter(appointment__in=others).update(
+                appointment=duplicate['first'])
+            Appointment.objects.filter(reschedule__in=others).update(reschedule=duplicate['first'])
+            Appointment.objects.filter(pk__in=others).delete()
+
+    def backwards(self, orm):
+        "Merged appointments cannot be restored."
+
+    models = {
+        u'appointments.appointment': {
+            'Meta': {'ordering': "[u'-date']", 'object_name': 'Appointment'},
+            'confirmed': ('django.db.models.fields.DateTimeField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            'date': ('django.db.models.fields.DateField', [], {}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'milestone': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "u'appointments'", 'to': u"orm['appointments.Milestone']"}),
+            'notes': ('django.db.models.fields.CharField', [], {'default': "u''", 'max_length': '160', 'blank': 'True'}),
+            'reschedule': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "u'appointments'", 'null': 'True', 'to': u"orm['appointments.Appointment']"}),
+            'status': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'subscription': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "u'appointments'", 'to': u"orm['appointments.TimelineSubscription']"})
+        },
+        u'appointments.milestone': {
+            'Meta': {'object_name': 'Milestone'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'offset': ('django.db.models.fields.IntegerField', [], {}),
+            'timeline': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "u'milestones'", 'to': u"orm['appointments.Timeline']"})
+        },
+        u'appointments.notification': {
+            'Meta': {'object_name': 'Notification'},
+            'appointment': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "u'notifications'", 'to': u"orm['appointments.Appointment']"}),
+            'confirmed': ('django.db.models.fields.DateTimeField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'message': ('django.db.models.fields.CharField', [], {'max_length': '160'}),
+            'sent': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'null': 'True', 'blank': 'True'}),
+            'status': ('django.db.models.fields.IntegerField', [], {'default': '1'})
+        },
+        u'appointments.timeline': {
+            'Meta': {'object_name': 'Timeline'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'slug': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        u'appointments.timelinesubscription': {
+            'Meta': {'object_name': 'TimelineSubscription'},
+            'connection': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "u'timelines'", 'to': u"orm['rapidsms.Connection']"}),
+            'end': ('django.db.models.fields.DateTimeField', [], {'default': 'None', 'null': 'True'}),
+            'generated_through': ('django.db.models.fields.DateField', [], {'default': 'None', 'null': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'pin': ('django.db.models.fields.CharField', [], {'max_length': '160'}),
+            'start': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'timeline': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "u'subscribers'", 'to': u"orm['appointments.Timeline']"})
+        },
+        u'rapidsms.backend': {
+            'Meta': {'object_name': 'Backend'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '20'})
+        },
+        u'rapidsms.connection': {
+            'Meta': {'unique_together': "(('backend', 'identity'),)", 'object_name': 'Connection'},
+            'backend': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['rapidsms.Backend']"}),
+            'contact': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['rapidsms.Contact']", 'null': 'True', 'blank': 'True'}),
+            'created_on': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'identity': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'modified_on': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'})
+        },
+        u'rapidsms.contact': {
+            'Meta': {'object_name': 'Contact'},
+            'created_on': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'language': ('django.db.models.fields.CharField', [], {'max_length': '6', 'blank': 'True'}),
+            'modified_on': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['appointments']
+    symmetrical = True
@@ -1,8 +1,12 @@
 from __future__ import unicode_literals
 
 import datetime
+from bisect import bisect_left, bisect_right
 
-from django.db import models
+from django.core.cache import cache
+from django.db import connection, models, transaction, IntegrityError
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 try:
     from django.utils.timezone import now
@@ -25,6 +29,10 @@ class Timeline(models.Model):
     def keywords(self):
         return map(lambda k: k.strip().lower(), self.slug.split('|'))
 
+    def milestones_between(self, first, last):
+        "(offset, milestone id) pairs for the milestones with an offset in the inclusive range."
+        return get_milestones_between(self.pk, first, last)
+
 
 class TimelineSubscription(models.Model):
     "Subscribing a user to a timeline of reminders."
@@ -34,10 +42,51 @@ class TimelineSubscription(models.Model):
     pin = models.CharField(max_length=160, help_text=_('Name, phrase, or digits used when joining the timeline.'))
     start = models.DateTimeField(_('start date'), default=now)
     end = models.DateTimeField(_('end date'), default=None, null=True)
+    generated_through = models.DateField(_('appointments generated through'),
+        default=None, null=True, editable=False)
 
     def __unicode__(self):
         return '%s - %s' % (self.connection, self.timeline)
 
+    def insert_unless_active(self):
+        """
+        Insert this subscription unless the connection already has an active
+        subscription to the timeline with the same pin.
+
+        The check and the insert are a single INSERT ... SELECT statement and the
+        unique index on open-ended subscriptions catches concurrent duplicates.
+        Returns whether the subscription was inserted. The instance is not
+        assigned a primary key.
+        """
+        qn = connection.ops.quote_name
+        fields = [f for f in self._meta.local_fields if not isinstance(f, models.AutoField)]
+        sql = """
+            INSERT INTO {table} ({columns})
+            SELECT {values} {from_dual}
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {table}
+                WHERE {timeline} = %s AND {connection} = %s AND {pin} = %s
+                AND ({end} IS NULL OR {end} >= %s)
+            )
+        """.format(
+            table=qn(self._meta.db_table), columns=', '.join([qn(f.column) for f in fields]),
+            values=', '.join(['%s'] * len(fields)), from_dual='FROM DUAL' if connection.vendor == 'mysql' else '',
+            timeline=qn('timeline_id'), connection=qn('connection_id'), pin=qn('pin'), end=qn('end'),
+        )
+        params = [f.get_db_prep_save(f.pre_save(self, True), connection=connection) for f in fields]
+        params.extend([self.timeline_id, self.connection_id, self.pin,
+                       self._meta.get_field('end').get_db_prep_save(now(), connection=connection)])
+        with transaction.commit_on_success():
+            sid = transaction.savepoint()
+            try:
+                cursor = connection.cursor()
+                cursor.execute(sql, params)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                return False
+            transaction.savepoint_commit(sid)
+            return cursor.rowcount == 1
+
 
 class Milestone(models.Model):
     "A point on the timeline that needs an appointment."
@@ -65,17 +114,34 @@ class Appointment(models.Model):
 
     milestone = models.ForeignKey(Milestone, related_name='appointments')
     subscription = models.ForeignKey(TimelineSubscription, related_name='appointments')
+    # Copied from the subscription to avoid joins
+    timeline = models.ForeignKey(Timeline, related_name='appointments',
+        blank=True, null=True, default=None, editable=False)
+    connection = models.ForeignKey('rapidsms.Connection', related_name='appointments',
+        blank=True, null=True, default=None, editable=False)
     date = models.DateField(_('appointment date'))
     confirmed = models.DateTimeField(blank=True, null=True, default=None)
     reschedule = models.ForeignKey('self', blank=True, null=True, related_name='appointments')
     status = models.IntegerField(choices=STATUS_CHOICES, default=STATUS_DEFAULT)
     notes = models.CharField(max_length=160, blank=True, default='')
+    claim_token = models.CharField(max_length=32, blank=True, default='', editable=False)
+    claimed = models.DateTimeField(blank=True, null=True, default=None, editable=False)
+    # Status of the latest Notification or None if no reminder was queued yet
+    last_notification_status = models.IntegerField(blank=True, null=True, default=None, editable=False)
 
     def __unicode__(self):
         return 'Appointment for %s on %s' % (self.subscription.connection, self.date.isoformat())
 
+    def save(self, *args, **kwargs):
+        if self.subscription_id is not None:
+            # Keep the copies in step if the subscription was changed
+            self.timeline_id = self.subscription.timeline_id
+            self.connection_id = self.subscription.connection_id
+        super(Appointment, self).save(*args, **kwargs)
+
     class Meta:
         ordering = ['-date']
+        unique_together = ('subscription', 'milestone', 'date')
         permissions = (
             ('view_appointment', 'Can View Appointments'),
         )
@@ -88,12 +154,16 @@ class Notification(models.Model):
     STATUS_CONFIRMED = 2
     STATUS_MANUAL = 3
     STATUS_ERROR = 4
+    STATUS_PENDING = 5
+    STATUS_FAILED = 6
 
     STATUS_CHOICES = (
         (STATUS_SENT, _('Sent')),
         (STATUS_CONFIRMED, _('Confirmed')),
         (STATUS_MANUAL, _('Manually Confirmed')),
         (STATUS_ERROR, _('Error')),
+        (STATUS_PENDING, _('Pending')),
+        (STATUS_FAILED, _('Failed')),
     )
 
     appointment = models.ForeignKey(Appointment, related_name='notifications')
@@ -101,8 +171,13 @@ class Notification(models.Model):
     sent = models.DateTimeField(blank=True, null=True, default=now)
     confirmed = models.DateTimeField(blank=True, null=True, default=None)
     message = models.CharField(max_length=160)
+    attempts = models.IntegerField(default=0, editable=False)
+    next_attempt = models.DateTimeField(blank=True, null=True, default=None, editable=False)
 
     def __unicode__(self):
+        if self.sent is None:
+            # Reminders in the outbox haven't been sent yet
+            return 'Pending notification for %s' % self.appointment.subscription.connection
         return 'Notification for %s on %s' %\
                (self.appointment.subscription.connection, self.sent.isoformat())
 
@@ -114,4 +189,101 @@ class Notification(models.Model):
         self.status = status
         Notification.objects.filter(pk=self.pk).update(confirmed=confirmed, status=status)
         self.appointment.confirmed = confirmed
-        Appointment.objects.filter(pk=self.appointment_id).update(confirmed=confirmed)
+        self.appointment.last_notification_status = status
+        Appointment.objects.filter(pk=self.appointment_id).update(
+            confirmed=confirmed, last_notification_status=status)
+
+
+MILESTONE_INDEX_KEY = 'appointments-milestone-index-%s'
+KEYWORD_INDEX_KEY = 'appointments-keyword-index'
+
+
+def get_milestone_index(timeline, refresh=False):
+    """
+    Sorted offsets and the matching milestone ids for a timeline id.
+
+    The index is cached until a milestone of the timeline is saved or deleted.
+    The cache may be local to the process which saved the milestone, so
+    `refresh` reads the index from the database and caches it again.
+    """
+    key = MILESTONE_INDEX_KEY % timeline
+    index = None if refresh else cache.get(key)
+    if index is None:
+        pairs = sorted(Milestone.objects.filter(timeline=timeline).values_list('offset', 'id'))
+        index = ([offset for offset, pk in pairs], [pk for offset, pk in pairs])
+        cache.set(key, index)
+    return index
+
+
+def get_milestones_between(timeline, first, last, index=None):
+    "(offset, milestone id) pairs for the timeline id with an offset in the inclusive range."
+    offsets, milestones = index or get_milestone_index(timeline)
+    lo, hi = bisect_left(offsets, first), bisect_right(offsets, last)
+    return zip(offsets[lo:hi], milestones[lo:hi])
+
+
+def get_keyword_index():
+    """
+    Dictionary of each normalized keyword to its Timeline.
+
+    When timelines share a keyword the oldest one wins. The index is cached
+    until a timeline is saved or deleted.
+    """
+    index = cache.get(KEYWORD_INDEX_KEY)
+    if index is None:
+        index = {}
+        for timeline in Timeline.objects.order_by('id'):
+            for keyword in timeline.keywords:
+                if keyword:
+                    index.setdefault(keyword, timeline)
+        cache.set(KEYWORD_INDEX_KEY, index)
+    return index
+
+
+def get_timeline_for_keyword(keyword):
+    "The Timeline matching the keyword from a message or None."
+    return get_keyword_index().get(keyword.strip().lower())
+
+
+@receiver(post_save, sender=Timeline)
+@receiver(post_delete, sender=Timeline)
+def clear_keyword_index(sender, instance, **kwargs):
+    "Drop the cached keywords of all timelines."
+    cache.delete(KEYWORD_INDEX_KEY)
+
+
+@receiver(post_save, sender=TimelineSubscription)
+def copy_subscription_fields(sender, instance, created, **kwargs):
+    "Update the timeline and connection copied onto the appointments of the subscription."
+    if not created:
+        Appointment.objects.filter(subscription=instance).exclude(
+            timeline=instance.timeline_id, connection=instance.connection_id,
+        ).update(timeline=instance.timeline_id, connection=instance.connection_id)
+
+
+@receiver(post_save, sender=Notification)
+def set_last_notification_status(sender, instance, **kwargs):
+    "Record the status of the saved notification on its appointment."
+    Appointment.objects.filter(pk=instance.appointment_id).update(last_notification_status=instance.status)
+
+
+@receiver(post_delete, sender=Notification)
+def reset_last_notification_status(sender, instance, **kwargs):
+    "Fall back to the status of the appointment's latest remaining notification."
+    latest = Notification.objects.filter(appointment=instance.appointment_id).order_by('-id')
+    status = latest.values_list('status', flat=True)[:1]
+    Appointment.objects.filter(pk=instance.appointment_id).update(
+        last_notification_status=status[0] if status else None)
+
+
+@receiver(post_save, sender=Milestone)
+@receiver(post_delete, sender=Milestone)
+def clear_milestone_index(sender, instance, **kwargs):
+    "Drop the cached offsets of the milestone's timeline."
+    cache.delete(MILESTONE_INDEX_KEY % instance.timeline_id)
+
+
+@receiver(post_save, sender=Milestone)
+def reset_generated_through(sender, instance, **kwargs):
+    "New or changed milestones require the full window to be generated again."
+    TimelineSubscription.objects.filter(timeline=instance.timeline_id).update(generated_through=None)
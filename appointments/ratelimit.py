@@ -0,0 +1,73 @@
+"Rate limiting for outbound messages shared through the cache."
+
+import threading
+import time
+
+from django.core.cache import cache as default_cache
+
+RATE_LIMIT_KEY = 'appointments-rate-%s-%s'
+
+
+class SharedRateLimiter(object):
+    """
+    Allow `rate` messages per second on average with bursts of up to `capacity`.
+
+    Time is split into periods of `capacity / rate` seconds which each admit up
+    to `capacity` messages. The messages taken in each period are counted in the
+    cache with incr, so every process sharing a cache backend with an atomic
+    incr, such as memcached, shares the rate. Taking more messages than are left
+    sleeps until the next period. The limiter can be shared between threads.
+    """
+
+    def __init__(self, name, rate, capacity=None, cache=None, clock=time.time, sleep=time.sleep):
+        self.name = name
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.period = self.capacity / self.rate
+        self.cache = cache or default_cache
+        self.clock = clock
+        self.sleep = sleep
+        # incr of the local memory cache isn't atomic between threads
+        self.lock = threading.Lock()
+
+    def take(self, count, period):
+        "Count `count` messages against the period. Returns the total taken in it."
+        key = RATE_LIMIT_KEY % (self.name, period)
+        with self.lock:
+            while True:
+                # Keep the count for a while after the period ends
+                self.cache.add(key, 0, int(self.period) + 60)
+                try:
+                    return self.cache.incr(key, count)
+                except ValueError:
+                    # The count expired between add and incr
+                    pass
+
+    def consume(self, count=1):
+        "Take `count` messages, sleeping if needed. Returns the number of seconds slept."
+        slept = 0
+        while True:
+            current = self.clock()
+            period = int(current // self.period)
+            taken = self.take(count, period)
+            # A single request larger than the capacity gets a period of its own
+            if taken <= self.capacity or taken == count:
+                return slept
+            wait = max(0, (period + 1) * self.period - current)
+            self.sleep(wait)
+            slept += wait
+
+
+def get_rate_limiters(rates, **kwargs):
+    """
+    Build a SharedRateLimiter for each backend name from a mapping of names to
+    either a rate in messages per second or a (rate, capacity) pair.
+    """
+    limiters = {}
+    for name, rate in rates.items():
+        if isinstance(rate, (list, tuple)):
+            rate, capacity = rate
+        else:
+            capacity = None
+        limiters[name] = SharedRateLimiter(name, rate, capacity, **kwargs)
+    return limiters
@@ -3,15 +3,15 @@ import django_tables2 as tables
 
 
 class ApptTable(tables.Table):
-    timeline = tables.Column(accessor=tables.utils.A('milestone.timeline'),
-                             order_by="milestone.timeline")
-    connection = tables.Column(accessor=tables.utils.A('subscription.connection'),
-                               order_by="subscription.connection")
+    timeline = tables.Column(accessor=tables.utils.A('timeline'),
+                             order_by="timeline")
+    connection = tables.Column(accessor=tables.utils.A('connection'),
+                               order_by="connection")
     subscription = tables.Column(accessor=tables.utils.A('subscription.pin'),
                                  order_by="subscription.pin")
     milestone = tables.Column(orderable=False)
 
     class Meta:
         model = Appointment
-        exclude = ('id', 'notes')
+        exclude = ('id', 'notes', 'claim_token', 'claimed', 'last_notification_status')
         sequence = ("timeline", "...", "connection", "subscription")
@@ -1,8 +1,15 @@
 import datetime
+import uuid
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 
-from celery import task
+from celery import chord, task
+from celery.utils.log import get_task_logger
 
-from django.db.models import Q, F
+from django.conf import settings
+from django.db import close_connection, connection, transaction, IntegrityError
+from django.db.models import AutoField, Q, F, Min, Max
+from django.utils import translation
 from django.utils.translation import ugettext_lazy as _
 try:
     from django.utils.timezone import now
@@ -11,58 +18,696 @@ except ImportError:  # Django < 1.4
 
 from rapidsms.router import send
 
-from .models import TimelineSubscription, Appointment, Notification
+from .models import TimelineSubscription, Milestone, Appointment, Notification
+from .models import get_milestone_index, get_milestones_between
+from .ratelimit import get_rate_limiters
+from .windows import get_local_date, get_send_windows
+
+logger = get_task_logger(__name__)
 
 APPT_REMINDER = _('This is a reminder for your upcoming appointment on %(date)s. Please confirm.')
 
 
+def _get_batch_size(batch_size=None):
+    "Number of rows to read or write per query in the bulk tasks."
+    return batch_size or getattr(settings, 'APPOINTMENTS_BATCH_SIZE', 1000)
+
+
+# Statement prefix and suffix which skip rows violating a unique constraint
+INSERT_IGNORE_SQL = {
+    'postgresql': ('INSERT INTO', 'ON CONFLICT DO NOTHING'),
+    'sqlite': ('INSERT OR IGNORE INTO', ''),
+    'mysql': ('INSERT IGNORE INTO', ''),
+}
+
+
+def _get_insert_ignore_sql():
+    "The INSERT_IGNORE_SQL of the database or None if it has no such statement."
+    if connection.vendor == 'postgresql' and connection.pg_version < 90500:
+        # ON CONFLICT was added in PostgreSQL 9.5
+        return None
+    return INSERT_IGNORE_SQL.get(connection.vendor)
+
+
+def _insert_ignore(objs, batch_size):
+    """
+    Insert the objects in batches, skipping those which violate a unique constraint.
+
+    Returns the number of rows inserted.
+    """
+    if not objs:
+        return 0
+    model = objs[0].__class__
+    fields = [f for f in model._meta.local_fields if not isinstance(f, AutoField)]
+    batch_size = min(batch_size, connection.ops.bulk_batch_size(fields, objs))
+    inserted = 0
+    insert_ignore = _get_insert_ignore_sql()
+    with transaction.commit_on_success():
+        if insert_ignore is None:
+            # Insert each row in a savepoint so a conflict only discards that row
+            for obj in objs:
+                sid = transaction.savepoint()
+                try:
+                    model.objects.bulk_create([obj])
+                except IntegrityError:
+                    transaction.savepoint_rollback(sid)
+                else:
+                    transaction.savepoint_commit(sid)
+                    inserted += 1
+            return inserted
+        qn = connection.ops.quote_name
+        prefix, suffix = insert_ignore
+        row = '(%s)' % ', '.join(['%s'] * len(fields))
+        cursor = connection.cursor()
+        for i in range(0, len(objs), batch_size):
+            batch = objs[i:i + batch_size]
+            sql = '%s %s (%s) VALUES %s %s' % (
+                prefix, qn(model._meta.db_table), ', '.join([qn(f.column) for f in fields]),
+                ', '.join([row] * len(batch)), suffix,
+            )
+            params = [f.get_db_prep_save(f.pre_save(obj, True), connection=connection)
+                      for obj in batch for f in fields]
+            cursor.execute(sql, params)
+            inserted += cursor.rowcount
+    return inserted
+
+
+def _get_active_subscriptions():
+    "Subscriptions which haven't ended."
+    return TimelineSubscription.objects.filter(Q(end__gte=now()) | Q(end__isnull=True))
+
+
+def _get_shard_ranges(shards):
+    "Split the ids of the active subscriptions into at most `shards` inclusive ranges."
+    bounds = _get_active_subscriptions().aggregate(first=Min('id'), last=Max('id'))
+    if bounds['first'] is None:
+        return []
+    step = -(-(bounds['last'] - bounds['first'] + 1) // shards)
+    return [(first, min(first + step - 1, bounds['last']))
+            for first in range(bounds['first'], bounds['last'] + 1, step)]
+
+
+def _iter_chunks(queryset, size, *fields):
+    """
+    Walk the queryset in primary key order, yielding lists of at most `size`
+    value tuples which start with the primary key.
+
+    Each chunk is fetched with its own query starting after the last key of the
+    previous chunk, so memory use doesn't grow with the size of the table.
+    """
+    queryset = queryset.order_by('pk')
+    last = None
+    while True:
+        chunk = queryset if last is None else queryset.filter(pk__gt=last)
+        chunk = list(chunk.values_list('pk', *fields)[:size])
+        if not chunk:
+            break
+        yield chunk
+        if len(chunk) < size:
+            break
+        last = chunk[-1][0]
+
+
+def _generate_in_python(subs, start, end, batch_size, rebuild=False):
+    "Compute the missing appointments in Python and insert them in batches."
+    # Milestone offsets of each timeline, read from the database once per run
+    # since the cached index of this process may miss milestones saved elsewhere
+    indexes = {}
+    scanned = created = 0
+    for chunk in _iter_chunks(subs, batch_size, 'timeline', 'connection', 'start', 'generated_through'):
+        first, last = chunk[0][0], chunk[-1][0]
+        scanned += len(chunk)
+        # Appointment(s) this chunk of subscriptions should have within the task window
+        wanted = set()
+        for pk, timeline, cnx, sub_start, generated_through in chunk:
+            window_start = start
+            if generated_through is not None and not rebuild:
+                window_start = max(start, generated_through + datetime.timedelta(days=1))
+            if timeline not in indexes:
+                indexes[timeline] = get_milestone_index(timeline, refresh=True)
+            sub_date = sub_start.date()
+            offsets = ((window_start - sub_date).days, (end - sub_date).days)
+            for offset, milestone in get_milestones_between(timeline, *offsets, index=indexes[timeline]):
+                wanted.add((pk, milestone, sub_date + datetime.timedelta(days=offset), timeline, cnx))
+        # Appointments which already exist are skipped by the unique constraint
+        created += _insert_ignore([
+            Appointment(subscription_id=sub, milestone_id=milestone, date=date,
+                        timeline_id=timeline, connection_id=cnx)
+            for sub, milestone, date, timeline, cnx in sorted(wanted)
+        ], batch_size)
+        # Move the watermark forward but never back
+        TimelineSubscription.objects.filter(
+            Q(generated_through__isnull=True) | Q(generated_through__lt=end),
+            id__range=(first, last),
+        ).update(generated_through=end)
+    return scanned, created
+
+
+# SQL for the date of a milestone for a subscription in each supported database
+MILESTONE_DATE_SQL = {
+    'postgresql': 'CAST(s.{start} AS date) + m.{offset}',
+    'sqlite': "date(s.{start}, m.{offset} || ' days')",
+}
+
+
+def _generate_in_database(subs, start, end, rebuild=False):
+    "Insert the missing appointments with a single INSERT ... SELECT statement."
+    qn = connection.ops.quote_name
+    date_sql = MILESTONE_DATE_SQL[connection.vendor].format(start=qn('start'), offset=qn('offset'))
+    subs_sql, subs_params = subs.values_list('id').query.get_compiler(connection=connection).as_sql()
+    window_sql = ''
+    if not rebuild:
+        window_sql = 'AND (s.{generated} IS NULL OR {date} > s.{generated})'.format(
+            generated=qn('generated_through'), date=date_sql)
+    insert, conflict = _get_insert_ignore_sql()
+    sql = """
+        {insert} {appointment} ({subscription}, {milestone}, {timeline}, {connection},
+            {date}, {status}, {notes}, {claim_token})
+        SELECT s.{id}, m.{id}, s.{timeline}, s.{connection}, {milestone_date}, %s, %s, %s
+        FROM {timelinesubscription} s
+        INNER JOIN {milestone_table} m ON m.{timeline} = s.{timeline}
+        WHERE s.{id} IN ({subs})
+        AND {milestone_date} >= %s AND {milestone_date} <= %s {window}
+        AND NOT EXISTS (
+            SELECT 1 FROM {appointment} a
+            WHERE a.{subscription} = s.{id} AND a.{milestone} = m.{id} AND a.{date} = {milestone_date}
+        ) {conflict}
+    """.format(
+        insert=insert, conflict=conflict,
+        appointment=qn(Appointment._meta.db_table),
+        timelinesubscription=qn(TimelineSubscription._meta.db_table),
+        milestone_table=qn(Milestone._meta.db_table),
+        id=qn('id'), subscription=qn('subscription_id'), milestone=qn('milestone_id'),
+        timeline=qn('timeline_id'), connection=qn('connection_id'),
+        date=qn('date'), status=qn('status'), notes=qn('notes'),
+        claim_token=qn('claim_token'),
+        milestone_date=date_sql, subs=subs_sql, window=window_sql,
+    )
+    params = [Appointment.STATUS_DEFAULT, '', '']
+    params.extend(subs_params)
+    params.extend([connection.ops.value_to_db_date(start), connection.ops.value_to_db_date(end)])
+    with transaction.commit_on_success():
+        scanned = subs.count()
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        created = cursor.rowcount
+        subs.filter(Q(generated_through__isnull=True) | Q(generated_through__lt=end)).update(generated_through=end)
+    return scanned, created
+
+
 @task()
-def generate_appointments(days=14):
+def generate_appointments(days=14, batch_size=None, min_id=None, max_id=None, rebuild=False, in_database=None):
     """
     Task to create Appointment instances based on current TimelineSubscriptions
 
+    Each subscription records the last date its appointments were generated
+    through so only the days which have entered the window since the previous
+    run are computed.
+
     Arguments:
     days: The number of upcoming days to create Appointments for
+    batch_size: The number of subscriptions handled per query (defaults to
+        the APPOINTMENTS_BATCH_SIZE setting)
+    min_id, max_id: Optional inclusive bounds on the ids of the
+        TimelineSubscriptions to handle
+    rebuild: Ignore the previous runs and compute the full window
+    in_database: Compute and insert the appointments with a single SQL
+        statement on PostgreSQL 9.5 or later and SQLite (defaults to the
+        APPOINTMENTS_GENERATE_IN_DATABASE setting)
+
+    Returns a dictionary with the number of subscriptions scanned and the
+    number of appointments created.
     """
     start = datetime.date.today()
     end = start + datetime.timedelta(days=days)
+    if in_database is None:
+        in_database = getattr(settings, 'APPOINTMENTS_GENERATE_IN_DATABASE', False)
 
-    subs = TimelineSubscription.objects.filter(Q(end__gte=now()) | Q(end__isnull=True))
+    subs = _get_active_subscriptions()
+    if not rebuild:
+        subs = subs.filter(Q(generated_through__isnull=True) | Q(generated_through__lt=end))
+    if min_id is not None:
+        subs = subs.filter(id__gte=min_id)
+    if max_id is not None:
+        subs = subs.filter(id__lte=max_id)
 
-    for sub in subs:
-        for milestone in sub.timeline.milestones.all():
-            milestone_date = sub.start.date() + datetime.timedelta(days=milestone.offset)
-            #Create appointment(s) for this subscription within the task window
-            if start <= milestone_date <= end:
-                appt, created = Appointment.objects.get_or_create(
-                                                    subscription=sub,
-                                                    milestone=milestone,
-                                                    date=milestone_date
-                                                    )
+    if in_database and connection.vendor in MILESTONE_DATE_SQL and _get_insert_ignore_sql() is not None:
+        scanned, created = _generate_in_database(subs, start, end, rebuild=rebuild)
+    else:
+        scanned, created = _generate_in_python(subs, start, end, _get_batch_size(batch_size), rebuild=rebuild)
+    logger.info('Scanned %s subscription(s) and created %s appointment(s).', scanned, created)
+    return {'scanned': scanned, 'created': created}
 
 
 @task()
-def send_appointment_notifications(days=7):
+def combine_generation_counts(results):
+    "Sum the counts returned by each generate_appointments shard."
+    return {
+        'scanned': sum(result['scanned'] for result in results),
+        'created': sum(result['created'] for result in results),
+    }
+
+
+@task()
+def generate_appointments_parallel(days=14, shards=None, batch_size=None, rebuild=False):
+    """
+    Task to fan out generate_appointments across workers
+
+    The active TimelineSubscriptions are split into id ranges and each range is
+    handled by its own generate_appointments subtask. The subtasks run as a chord
+    so this requires a Celery result backend.
+
+    Arguments:
+    days: The number of upcoming days to create Appointments for
+    shards: The number of subtasks to split the work into (defaults to the
+        APPOINTMENTS_GENERATE_SHARDS setting)
+    batch_size: The number of subscriptions handled per query by each subtask
+    rebuild: Ignore the previous runs and compute the full window
+
+    Returns the id of the chord result holding the combined counts or None
+    if there are no active subscriptions.
+    """
+    shards = shards or getattr(settings, 'APPOINTMENTS_GENERATE_SHARDS', 8)
+    header = [
+        generate_appointments.subtask((days, ), {
+            'batch_size': batch_size, 'min_id': first, 'max_id': last, 'rebuild': rebuild,
+        })
+        for first, last in _get_shard_ranges(shards)
+    ]
+    if not header:
+        return None
+    return chord(header)(combine_generation_counts.s()).id
+
+
+def _claim_appointments(appts, limit, after=None):
+    """
+    Reserve up to `limit` of the appointments for this worker, soonest first.
+
+    Appointments are claimed with a conditional UPDATE of the appointments
+    table so concurrent workers never claim the same row. The rows may have
+    been handled by another worker since they were selected, so callers must
+    check that the claimed rows are still due. Claims older than the
+    APPOINTMENTS_CLAIM_TIMEOUT setting (in seconds) are assumed to belong to a
+    worker which died. Only appointments after the (date, id) pair `after` are
+    considered so successive claims walk the appointments in date order.
+
+    Returns the claim token and the last (date, id) pair considered, or None
+    and `after` if there was nothing left to claim.
+    """
+    timeout = getattr(settings, 'APPOINTMENTS_CLAIM_TIMEOUT', 60 * 60)
+    unclaimed = Q(claimed__isnull=True) | Q(claimed__lt=now() - datetime.timedelta(seconds=timeout))
+    if after is not None:
+        date, pk = after
+        appts = appts.filter(Q(date__gt=date) | Q(date=date, id__gt=pk))
+    rows = list(appts.filter(unclaimed).order_by('date', 'id').values_list('date', 'id').distinct()[:limit])
+    if not rows:
+        return None, after
+    token = uuid.uuid4().hex
+    Appointment.objects.filter(unclaimed, pk__in=[pk for date, pk in rows]).update(
+        claim_token=token, claimed=now())
+    return token, rows[-1]
+
+
+def _release_appointments(tokens):
+    "Release the appointments claimed with the tokens."
+    Appointment.objects.filter(claim_token__in=tokens).update(claim_token='', claimed=None)
+
+
+def _get_retry_delay(attempts):
+    "Seconds to wait before retrying a reminder which failed `attempts` times."
+    delay = getattr(settings, 'APPOINTMENTS_SEND_RETRY_DELAY', 60)
+    return delay * 2 ** (attempts - 1)
+
+
+def _get_outbox(max_attempts):
+    "Pending and failed Notifications which are due to be sent."
+    return Notification.objects.filter(
+        Q(next_attempt__isnull=True) | Q(next_attempt__lte=now()),
+        status__in=[Notification.STATUS_PENDING, Notification.STATUS_ERROR],
+        attempts__lt=max_attempts,
+    )
+
+
+def _get_sendable(prefix=''):
+    """
+    Filter for the appointments, or the notifications with `prefix` set to
+    'appointment__', whose reminders can still be sent: the appointment hasn't
+    passed and its subscription hasn't ended.
+    """
+    return Q(**{prefix + 'date__gte': datetime.date.today()}) & (
+        Q(**{prefix + 'subscription__end__gte': now()}) | Q(**{prefix + 'subscription__end__isnull': True}))
+
+
+def _get_expired(prefix=''):
+    "The opposite of _get_sendable: the appointment has passed or its subscription has ended."
+    return Q(**{prefix + 'date__lt': datetime.date.today()}) | Q(**{prefix + 'subscription__end__lt': now()})
+
+
+def _expire_outbox():
+    """
+    Mark the reminders in the outbox which can no longer be sent as failed.
+
+    Returns the number of reminders marked.
+    """
+    outbox = [Notification.STATUS_PENDING, Notification.STATUS_ERROR]
+    with transaction.commit_on_success():
+        Appointment.objects.filter(_get_expired(), last_notification_status__in=outbox).update(
+            last_notification_status=Notification.STATUS_FAILED)
+        return Notification.objects.filter(_get_expired('appointment__'), status__in=outbox).update(
+            status=Notification.STATUS_FAILED, next_attempt=None)
+
+
+def _get_send_windows():
+    """
+    Send windows keyed by timeline keyword and by backend name, from the
+    APPOINTMENTS_TIMELINE_SEND_WINDOWS and APPOINTMENTS_BACKEND_SEND_WINDOWS settings.
+    """
+    slot = getattr(settings, 'APPOINTMENTS_SEND_SLOT_SIZE', 15)
+    timelines = getattr(settings, 'APPOINTMENTS_TIMELINE_SEND_WINDOWS', {})
+    return (
+        get_send_windows(dict((k.strip().lower(), v) for k, v in timelines.items()), slot),
+        get_send_windows(getattr(settings, 'APPOINTMENTS_BACKEND_SEND_WINDOWS', {}), slot),
+    )
+
+
+def _get_send_window(windows, slug, backend):
+    """
+    The window of the first keyword of the timeline slug which has one or else
+    the window of the backend.
+    """
+    timelines, backends = windows
+    for keyword in [slug] + slug.split('|'):
+        window = timelines.get(keyword.strip().lower())
+        if window is not None:
+            return window
+    return backends.get(backend)
+
+
+def _render_reminders(keys, templates, messages):
+    """
+    Render the reminder text for each (language, date) pair in `keys`.
+
+    The template is translated once per language and each text is formatted
+    once per pair. Both are stored in the given dictionaries so they can be
+    reused for the rest of the run.
+    """
+    for language, date in keys:
+        if (language, date) in messages:
+            continue
+        if language not in templates:
+            with translation.override(language or settings.LANGUAGE_CODE):
+                templates[language] = unicode(APPT_REMINDER)
+        messages[(language, date)] = templates[language] % {'date': date}
+    return messages
+
+
+def get_max_lateness(max_attempts=None):
+    """
+    How long the most overdue reminder in the outbox has been waiting, as a
+    timedelta. This is zero when the sender is keeping up.
+    """
+    max_attempts = max_attempts or getattr(settings, 'APPOINTMENTS_SEND_MAX_ATTEMPTS', 5)
+    outbox = _get_outbox(max_attempts).filter(_get_sendable('appointment__'))
+    due = outbox.aggregate(due=Min('next_attempt'))['due']
+    if due is None:
+        return datetime.timedelta(0)
+    return max(datetime.timedelta(0), now() - due)
+
+
+def _queue_reminders(appts, claim_size):
+    """
+    Write a pending Notification for each of the appointments, in the
+    language of its contact.
+
+    Returns the number of Notifications queued.
+    """
+    queued = 0
+    last = None
+    templates, messages = {}, {}
+    windows = _get_send_windows()
+    tokens = []
+    try:
+        while True:
+            token, last = _claim_appointments(appts, claim_size, last)
+            if token is None:
+                break
+            tokens.append(token)
+            # Appointments which got a reminder since they were selected are skipped
+            claimed = Appointment.objects.filter(
+                claim_token=token, last_notification_status__isnull=True,
+            ).order_by('date', 'id').values_list(
+                'id', 'date', 'connection__contact__language', 'timeline__slug', 'connection__backend__name')
+            _render_reminders(set((row[2], row[1]) for row in claimed), templates, messages)
+            # Reminders outside of any send window are due straight away
+            current = now()
+            grouped = defaultdict(list)
+            for row in claimed:
+                grouped[_get_send_window(windows, row[3], row[4])].append(row)
+            notifications = []
+            statuses = defaultdict(list)
+            for window, rows in grouped.items():
+                if window is None:
+                    slots = [current] * len(rows)
+                else:
+                    slots = window.spread(len(rows), current)
+                for (pk, date, language, timeline, backend), slot in zip(rows, slots):
+                    status, next_attempt = Notification.STATUS_PENDING, slot
+                    if window is not None and window.get_local_date(slot) > date:
+                        # The window doesn't open again before the appointment
+                        status, next_attempt = Notification.STATUS_FAILED, None
+                    statuses[status].append(pk)
+                    notifications.append(Notification(
+                        appointment_id=pk, status=status, sent=None,
+                        next_attempt=next_attempt, message=messages[(language, date)]))
+            with transaction.commit_on_success():
+                Notification.objects.bulk_create(notifications)
+                # bulk_create doesn't send post_save for the status receiver
+                for status, pks in statuses.items():
+                    Appointment.objects.filter(pk__in=pks).update(last_notification_status=status)
+            expired = len(statuses[Notification.STATUS_FAILED])
+            if expired:
+                logger.warning('%s reminder(s) could not be sent within a send window '
+                               'before the appointment.', expired)
+            queued += len(claimed) - expired
+    finally:
+        if tokens:
+            _release_appointments(tokens)
+    return queued
+
+
+def _drain_outbox(batch_size, workers, claim_size):
+    """
+    Send the due Notifications in the outbox, soonest appointment first.
+
+    Returns a dictionary with the number of reminders sent and failed along
+    with how late the most overdue reminder was sent.
+    """
+    max_attempts = getattr(settings, 'APPOINTMENTS_SEND_MAX_ATTEMPTS', 5)
+    limiters = get_rate_limiters(getattr(settings, 'APPOINTMENTS_SEND_RATES', {}))
+    windows = _get_send_windows()
+    counts = {'sent': 0, 'failed': 0}
+    lateness = datetime.timedelta(0)
+    expired = _expire_outbox()
+    if expired:
+        logger.warning('Marked %s reminder(s) for past appointments or ended subscriptions as failed.', expired)
+    tokens = []
+    last = None
+    try:
+        while True:
+            appts = Appointment.objects.filter(_get_sendable()).filter(
+                Q(notifications__next_attempt__isnull=True) | Q(notifications__next_attempt__lte=now()),
+                notifications__status__in=[Notification.STATUS_PENDING, Notification.STATUS_ERROR],
+                notifications__attempts__lt=max_attempts,
+            )
+            token, last = _claim_appointments(appts, claim_size, last)
+            if token is None:
+                break
+            tokens.append(token)
+            # Reminders sent or expired since the appointments were selected are skipped
+            outbox = _get_outbox(max_attempts).filter(
+                _get_sendable('appointment__'), appointment__claim_token=token,
+            ).select_related(
+                'appointment__connection__backend',
+                'appointment__connection__contact',
+                'appointment__timeline',
+            ).order_by('appointment__date', 'id')
+            lateness = max(lateness, _send_notifications(
+                list(outbox), batch_size, workers, limiters, max_attempts, counts, windows))
+    finally:
+        if tokens:
+            _release_appointments(tokens)
+    return counts, lateness
+
+
+def _send_batch(batch):
+    """
+    Send one reminder text for a batch of Notifications, waiting for the rate limiter.
+
+    Returns the batch along with whether it was sent.
+    """
+    msg, notifications, limiter = batch
+    connections = [n.appointment.connection for n in notifications]
+    if limiter is not None:
+        limiter.consume(len(notifications))
+    try:
+        send(msg, connections)
+    except Exception:
+        identities = ', '.join([connection.identity for connection in connections])
+        logger.exception('Failed to send reminder(s) to %s.', identities)
+        return batch, False
+    return batch, True
+
+
+def _send_batch_in_thread(batch):
+    "Send a batch from a pool thread and close the database connection of the thread."
+    try:
+        return _send_batch(batch)
+    finally:
+        # The outgoing phase of the apps may have opened a connection in this thread
+        close_connection()
+
+
+def _send_notifications(notifications, batch_size, workers, limiters, max_attempts, counts, windows):
+    """
+    Send the Notifications and record the result of each attempt.
+
+    Batches are sent in order of their soonest appointment. Returns how late
+    the most overdue of the sent reminders was.
+    """
+    groups = defaultdict(list)
+    for notification in notifications:
+        backend = notification.appointment.connection.backend.name
+        groups[(notification.message, backend)].append(notification)
+    batches = []
+    for (msg, backend), group in groups.items():
+        limiter = limiters.get(backend)
+        size = batch_size
+        if limiter is not None:
+            # Never send more at once than the backend allows in a burst
+            size = max(1, min(batch_size, int(limiter.capacity)))
+        for i in range(0, len(group), size):
+            batches.append((msg, group[i:i + size], limiter))
+    batches.sort(key=lambda batch: batch[1][0].appointment.date)
+    lateness = datetime.timedelta(0)
+
+    pool = None
+    if workers > 1 and len(batches) > 1:
+        # Threads only send; the notifications are written from this thread
+        pool = ThreadPool(min(workers, len(batches)))
+        results = pool.imap_unordered(_send_batch_in_thread, batches)
+    else:
+        results = (_send_batch(batch) for batch in batches)
+    try:
+        for (msg, batch, limiter), success in results:
+            current = now()
+            with transaction.commit_on_success():
+                if success:
+                    counts['sent'] += len(batch)
+                    for notification in batch:
+                        if notification.next_attempt is not None:
+                            lateness = max(lateness, current - notification.next_attempt)
+                    Notification.objects.filter(pk__in=[n.pk for n in batch]).update(
+                        status=Notification.STATUS_SENT, sent=current, next_attempt=None,
+                        attempts=F('attempts') + 1)
+                    Appointment.objects.filter(pk__in=[n.appointment_id for n in batch]).update(
+                        last_notification_status=Notification.STATUS_SENT)
+                    continue
+                counts['failed'] += len(batch)
+                failed = defaultdict(list)
+                for notification in batch:
+                    appointment = notification.appointment
+                    attempts = notification.attempts + 1
+                    # Give up on reminders which reached the maximum attempts
+                    status, next_attempt = Notification.STATUS_FAILED, None
+                    if attempts < max_attempts:
+                        status = Notification.STATUS_ERROR
+                        next_attempt = current + datetime.timedelta(seconds=_get_retry_delay(attempts))
+                        window = _get_send_window(
+                            windows, appointment.timeline.slug, appointment.connection.backend.name)
+                        local_date = get_local_date(next_attempt)
+                        if window is not None:
+                            # Retries which fall outside of the window wait for it to open
+                            next_attempt = window.next_open(next_attempt)
+                            local_date = window.get_local_date(next_attempt)
+                        if local_date > appointment.date:
+                            # Nor on those which can't be retried before the appointment
+                            status, next_attempt = Notification.STATUS_FAILED, None
+                    failed[(attempts, status, next_attempt)].append(notification)
+                for (attempts, status, next_attempt), group in failed.items():
+                    Notification.objects.filter(pk__in=[n.pk for n in group]).update(
+                        status=status, attempts=attempts, next_attempt=next_attempt)
+                    Appointment.objects.filter(pk__in=[n.appointment_id for n in group]).update(
+                        last_notification_status=status)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return lateness
+
+
+@task()
+def send_appointment_notifications(days=7, batch_size=None, workers=None):
     """
     Task to send reminders notifications for upcoming Appointment
 
+    A pending Notification is written for each upcoming Appointment which
+    doesn't have one yet, then the outbox of pending Notifications is sent.
+
     Arguments:
     days: The number of upcoming days to filter upcoming Appointments
+    batch_size: The maximum number of connections per send call (defaults
+        to the APPOINTMENTS_SEND_BATCH_SIZE setting)
+    workers: The number of threads sending batches concurrently (defaults
+        to the APPOINTMENTS_SEND_WORKERS setting)
+
+    Returns a dictionary with the number of reminders queued, sent and failed.
     """
     start = datetime.date.today()
     end = start + datetime.timedelta(days=days)
-    blacklist = [Notification.STATUS_SENT, Notification.STATUS_CONFIRMED, Notification.STATUS_MANUAL]
     appts = Appointment.objects.filter(
-        # Join subscriptions that haven't ended
-        Q(Q(subscription__connection__timelines__end__gte=now()) | Q(subscription__connection__timelines__end__isnull=True)),
-        subscription__connection__timelines__timeline=F('milestone__timeline'),
+        # Only the appointment's own subscription which hasn't ended
+        Q(subscription__end__gte=now()) | Q(subscription__end__isnull=True),
         # Filter appointments in range
         date__range=(start, end),
-    ).exclude(notifications__status__in=blacklist)
-    for appt in appts:
-        msg = APPT_REMINDER % {'date': appt.date}
-        send(msg, appt.subscription.connection)
-        Notification.objects.create(appointment=appt,
-                                    status=Notification.STATUS_SENT,
-                                    sent=now(),
-                                    message=msg)
+        # Without any reminder so far
+        last_notification_status__isnull=True,
+    )
+    claim_size = getattr(settings, 'APPOINTMENTS_CLAIM_SIZE', 500)
+    queued = _queue_reminders(appts, claim_size)
+    counts = send_pending_notifications(batch_size=batch_size, workers=workers)
+    counts['queued'] = queued
+    return counts
+
+
+@task()
+def send_pending_notifications(batch_size=None, workers=None):
+    """
+    Task to send the pending Notifications in the outbox
+
+    Reminders with the same text for connections on the same backend are
+    sent together with a single call to rapidsms.router.send. Backends listed
+    in the APPOINTMENTS_SEND_RATES setting are throttled to their rate.
+    Reminders which fail to send are retried with an exponential backoff
+    until they reach the APPOINTMENTS_SEND_MAX_ATTEMPTS setting, after which
+    they are marked as failed.
+
+    Appointments are claimed in chunks before their reminders are sent so any
+    number of workers can run the task at the same time without sending
+    duplicate reminders. Chunks are claimed and sent in order of appointment
+    date so that a backlog delays the reminders for later appointments first.
+
+    Arguments:
+    batch_size: The maximum number of connections per send call (defaults
+        to the APPOINTMENTS_SEND_BATCH_SIZE setting)
+    workers: The number of threads sending batches concurrently (defaults
+        to the APPOINTMENTS_SEND_WORKERS setting)
+
+    Returns a dictionary with the number of reminders sent and failed.
+    """
+    batch_size = batch_size or getattr(settings, 'APPOINTMENTS_SEND_BATCH_SIZE', 100)
+    workers = workers or getattr(settings, 'APPOINTMENTS_SEND_WORKERS', 1)
+    claim_size = getattr(settings, 'APPOINTMENTS_CLAIM_SIZE', 500)
+    counts, lateness = _drain_outbox(batch_size, workers, claim_size)
+    logger.info('Sent %(sent)s reminder(s), %(failed)s failed.', counts)
+    logger.info('The most overdue reminder was sent %s late.', lateness)
+    return counts
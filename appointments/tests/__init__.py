@@ -1,5 +1,10 @@
 from .test_app import AppointmentAppTestCase
+from .test_forms import HandlerFormTestCase
 from .test_handlers import ConfirmHandlerTestCase, MoveHandlerTestCase
 from .test_handlers import NewHandlerTestCase, QuitHandlerTestCase, StatusHandlerTestCase
-from .test_tasks import GenerateAppointmentsTestCase, SendAppointmentNotificationsTestCase
+from .test_models import AppointmentTestCase, IndexUsageTestCase, KeywordIndexTestCase
+from .test_models import LastNotificationStatusTestCase, MilestoneIndexTestCase, NotificationTestCase
+from .test_models import TimelineSubscriptionTestCase
+from .test_tasks import GenerateAppointmentsTestCase, GenerateAppointmentsParallelTestCase
+from .test_tasks import SendAppointmentNotificationsTestCase, SendWindowTestCase, SharedRateLimiterTestCase
 from .test_views import AppointmentListViewTestCase, AppointmentExportViewTestCase
@@ -4,6 +4,7 @@ import random
 import string
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
 
 from rapidsms.models import Connection, Backend
 from rapidsms.tests.harness import RapidTest
@@ -14,6 +15,11 @@ from ..models import Timeline, TimelineSubscription, Milestone, Appointment, Not
 class AppointmentDataTestCase(RapidTest):
     "Helper methods for creating test data."
 
+    def _pre_setup(self):
+        super(AppointmentDataTestCase, self)._pre_setup()
+        # Cached indexes may refer to rows from previous tests
+        cache.clear()
+
     def get_random_string(self, length=10):
         "Create a random string for generating test data."
         return ''.join(random.choice(string.ascii_letters) for x in range(length))
@@ -0,0 +1,31 @@
+from __future__ import unicode_literals
+
+from .base import AppointmentDataTestCase, now
+from ..forms import HandlerForm
+
+
+class HandlerFormTestCase(AppointmentDataTestCase):
+    "Shared helpers of the SMS handler forms."
+
+    def setUp(self):
+        self.timeline = self.create_timeline(name='Test', slug='foo')
+        self.connection = self.create_connection()
+        self.subscription = self.create_timeline_subscription(
+            timeline=self.timeline, connection=self.connection, pin='bar')
+        self.form = HandlerForm(data={'keyword': 'foo'}, connection=self.connection)
+
+    def test_get_subscription(self):
+        "The active subscription for the connection, timeline and pin should be returned."
+        self.assertEqual(self.subscription, self.form.get_subscription(self.timeline, 'bar'))
+        self.assertEqual(None, self.form.get_subscription(self.timeline, 'baz'))
+
+    def test_get_subscription_other_connection(self):
+        "Subscriptions of other connections should not match."
+        form = HandlerForm(data={'keyword': 'foo'}, connection=self.create_connection())
+        self.assertEqual(None, form.get_subscription(self.timeline, 'bar'))
+
+    def test_get_subscription_ended(self):
+        "Subscriptions which have ended should not match."
+        self.subscription.end = now()
+        self.subscription.save()
+        self.assertEqual(None, self.form.get_subscription(self.timeline, 'bar'))
@@ -4,11 +4,13 @@ from datetime import timedelta
 
 from .base import (AppointmentDataTestCase, Notification, Appointment,
     TimelineSubscription, now)
+from ..forms import NewForm
 from ..handlers.confirm import ConfirmHandler
 from ..handlers.move import MoveHandler
 from ..handlers.new import NewHandler
 from ..handlers.quit import QuitHandler
 from ..handlers.status import StatusHandler
+from ..models import get_keyword_index
 
 
 class NewHandlerTestCase(AppointmentDataTestCase):
@@ -61,6 +63,16 @@ class NewHandlerTestCase(AppointmentDataTestCase):
         reply = replies[0]
         self.assertTrue(reply.startswith('Sorry'))
 
+    def test_single_write(self):
+        "Joining should take a single query once the keywords are cached."
+        connection = self.create_connection()
+        form = NewForm(data={'keyword': 'foo', 'name': 'bar'}, connection=connection)
+        get_keyword_index()
+        with self.assertNumQueries(1):
+            self.assertTrue(form.is_valid())
+            self.assertTrue(form.save())
+        self.assertEqual(1, TimelineSubscription.objects.filter(connection=connection).count())
+
     def test_already_joined(self):
         "Attempting to register and already registered connection/name pair."
         connection = self.create_connection()
@@ -84,7 +96,7 @@ class ConfirmHandlerTestCase(AppointmentDataTestCase):
             timeline=self.timeline, connection=self.connection, pin='bar')
         ConfirmHandler._mock_backend = self.connection.backend
         self.milestone = self.create_milestone(timeline=self.timeline)
-        self.appointment = self.create_appointment(milestone=self.milestone)
+        self.appointment = self.create_appointment(milestone=self.milestone, subscription=self.subscription)
         self.notification = self.create_notification(appointment=self.appointment)
 
     def test_help(self):
@@ -106,6 +118,17 @@ class ConfirmHandlerTestCase(AppointmentDataTestCase):
         appointment = Appointment.objects.get(pk=self.appointment.pk)
         self.assertTrue(appointment.confirmed)
 
+    def test_other_subscription(self):
+        "Notifications for other subscriptions to the timeline should not be confirmed."
+        other = self.create_timeline_subscription(timeline=self.timeline, pin='bar')
+        appointment = self.create_appointment(milestone=self.milestone, subscription=other)
+        notification = self.create_notification(appointment=appointment)
+        self.notification.delete()
+        replies = ConfirmHandler.test('APPT CONFIRM foo bar', identity=self.connection.identity)
+        self.assertEqual(len(replies), 1)
+        self.assertTrue('no unconfirmed' in replies[0])
+        self.assertFalse(Notification.objects.get(pk=notification.pk).confirmed)
+
     def test_no_upcoming_appointment(self):
         "Matched user has no upcoming appointment notifications."
         self.notification.delete()
@@ -150,7 +173,7 @@ class StatusHandlerTestCase(AppointmentDataTestCase):
             timeline=self.timeline, connection=self.connection, pin='bar')
         StatusHandler._mock_backend = self.connection.backend
         self.milestone = self.create_milestone(timeline=self.timeline)
-        self.appointment = self.create_appointment(milestone=self.milestone)
+        self.appointment = self.create_appointment(milestone=self.milestone, subscription=self.subscription)
 
     def test_help(self):
         "Prefix and keyword should return the help."
@@ -161,8 +184,9 @@ class StatusHandlerTestCase(AppointmentDataTestCase):
 
     def test_appointment_status_updated(self):
         "Successfully update a recent appointment."
-        for status in Appointment.STATUS_CHOICES[1:]:
-            appt = self.create_appointment(milestone=self.milestone)
+        for days, status in enumerate(Appointment.STATUS_CHOICES[1:]):
+            appt = self.create_appointment(milestone=self.milestone, subscription=self.subscription,
+                                           date=now().date() - timedelta(days=days + 1))
             replies = StatusHandler.test('APPT STATUS foo bar %s' % status[1].upper(),
                                          identity=self.connection.identity)
             self.assertEqual(len(replies), 1)
@@ -203,6 +227,17 @@ class StatusHandlerTestCase(AppointmentDataTestCase):
         reply = replies[0]
         self.assertTrue('no recent appointments' in reply)
 
+    def test_other_subscription(self):
+        "Appointments for other subscriptions to the timeline should not be updated."
+        other = self.create_timeline_subscription(timeline=self.timeline, pin='bar')
+        appointment = self.create_appointment(milestone=self.milestone, subscription=other)
+        self.appointment.delete()
+        replies = StatusHandler.test('APPT STATUS foo bar SAW', identity=self.connection.identity)
+        self.assertEqual(len(replies), 1)
+        self.assertTrue('no recent appointments' in replies[0])
+        appointment = Appointment.objects.get(pk=appointment.pk)
+        self.assertEqual(Appointment.STATUS_DEFAULT, appointment.status)
+
     def test_no_subscription(self):
         "Name/ID does not match a subscription."
         self.subscription.delete()
@@ -231,7 +266,7 @@ class MoveHandlerTestCase(AppointmentDataTestCase):
             timeline=self.timeline, connection=self.connection, pin='bar')
         MoveHandler._mock_backend = self.connection.backend
         self.milestone = self.create_milestone(timeline=self.timeline)
-        self.appointment = self.create_appointment(milestone=self.milestone,
+        self.appointment = self.create_appointment(milestone=self.milestone, subscription=self.subscription,
                                                    date=now() + timedelta(hours=1))
         self.tomorrow = (now() + timedelta(days=1)).strftime('%Y-%m-%d')
 
@@ -271,6 +306,16 @@ class MoveHandlerTestCase(AppointmentDataTestCase):
         reply = replies[0]
         self.assertTrue(reply.startswith('Sorry, the reschedule date'))
 
+    def test_appointment_reschedule_same_date(self):
+        "The appointment cannot be rescheduled to a date it is already scheduled for."
+        today = self.appointment.date.strftime('%Y-%m-%d')
+        replies = MoveHandler.test('APPT MOVE foo bar %s' % today,
+                                   identity=self.connection.identity)
+        self.assertEqual(len(replies), 1)
+        reply = replies[0]
+        self.assertTrue(reply.startswith('Sorry, the appointment is already scheduled'))
+        self.assertEqual(1, Appointment.objects.all().count())
+
     def test_no_future_appointment(self):
         "Matched user has no future appointment."
         self.appointment.delete()
@@ -283,7 +328,8 @@ class MoveHandlerTestCase(AppointmentDataTestCase):
     def test_no_future_appointment_needing_update(self):
         "Matched user has no future appointment that needs rescheduling."
         reschedule = self.create_appointment(subscription=self.subscription,
-                                             milestone=self.milestone)
+                                             milestone=self.milestone,
+                                             date=now() + timedelta(days=2))
         self.appointment.reschedule = reschedule
         self.appointment.save()
         replies = MoveHandler.test('APPT MOVE foo bar %s' % self.tomorrow,
@@ -302,6 +348,18 @@ class MoveHandlerTestCase(AppointmentDataTestCase):
         reply = replies[0]
         self.assertTrue('no future appointments' in reply)
 
+    def test_other_subscription(self):
+        "Appointments for other subscriptions to the timeline should not be moved."
+        other = self.create_timeline_subscription(timeline=self.timeline, pin='bar')
+        appointment = self.create_appointment(milestone=self.milestone, subscription=other,
+                                              date=now() + timedelta(hours=1))
+        self.appointment.delete()
+        replies = MoveHandler.test('APPT MOVE foo bar %s' % self.tomorrow,
+                                     identity=self.connection.identity)
+        self.assertEqual(len(replies), 1)
+        self.assertTrue('no future appointments' in replies[0])
+        self.assertEqual(None, Appointment.objects.get(pk=appointment.pk).reschedule)
+
     def test_no_subscription(self):
         "Name/ID does not match a subscription."
         self.subscription.delete()
@@ -0,0 +1,309 @@
+from __future__ import unicode_literals
+
+from datetime import timedelta
+
+from django.db import connection, IntegrityError
+from django.db.models import Q
+from django.utils import unittest
+from django.utils.importlib import import_module
+
+try:
+    from south.db import db
+except ImportError:  # South is optional
+    db = None
+
+from .base import AppointmentDataTestCase, Appointment, Milestone, Notification, TimelineSubscription, now
+from ..models import get_milestone_index, get_keyword_index, get_timeline_for_keyword
+
+
+class MilestoneIndexTestCase(AppointmentDataTestCase):
+    "Cached and sorted milestone offsets for each timeline."
+
+    def setUp(self):
+        self.timeline = self.create_timeline(name='Test', slug='foo')
+        self.milestones = dict(
+            (offset, self.create_milestone(offset=offset, timeline=self.timeline))
+            for offset in [30, 7, 1, 14, 3]
+        )
+
+    def test_sorted_offsets(self):
+        "Offsets should be sorted along with their milestone ids."
+        offsets, milestones = get_milestone_index(self.timeline.pk)
+        self.assertEqual([1, 3, 7, 14, 30], offsets)
+        self.assertEqual([self.milestones[x].pk for x in offsets], milestones)
+
+    def test_milestones_between(self):
+        "Only milestones with offsets within the inclusive range should be returned."
+        result = self.timeline.milestones_between(3, 14)
+        expected = [(x, self.milestones[x].pk) for x in [3, 7, 14]]
+        self.assertEqual(expected, result)
+        self.assertEqual([], self.timeline.milestones_between(15, 29))
+        self.assertEqual([], self.timeline.milestones_between(-10, 0))
+
+    def test_cached(self):
+        "The index should only be queried once."
+        get_milestone_index(self.timeline.pk)
+        with self.assertNumQueries(0):
+            self.timeline.milestones_between(0, 30)
+
+    def test_invalidate_on_save(self):
+        "Saving a milestone should drop the cached index."
+        get_milestone_index(self.timeline.pk)
+        milestone = self.milestones[30]
+        milestone.offset = 2
+        milestone.save()
+        offsets, milestones = get_milestone_index(self.timeline.pk)
+        self.assertEqual([1, 2, 3, 7, 14], offsets)
+
+    def test_invalidate_on_delete(self):
+        "Deleting a milestone should drop the cached index."
+        get_milestone_index(self.timeline.pk)
+        self.milestones[1].delete()
+        offsets, milestones = get_milestone_index(self.timeline.pk)
+        self.assertEqual([3, 7, 14, 30], offsets)
+
+    def test_refresh(self):
+        "Refreshing should read milestones the cached index misses."
+        get_milestone_index(self.timeline.pk)
+        # As if saved by another process with its own cache
+        Milestone.objects.filter(pk=self.milestones[30].pk).update(offset=2)
+        self.assertEqual([1, 3, 7, 14, 30], get_milestone_index(self.timeline.pk)[0])
+        self.assertEqual([1, 2, 3, 7, 14], get_milestone_index(self.timeline.pk, refresh=True)[0])
+        self.assertEqual([1, 2, 3, 7, 14], get_milestone_index(self.timeline.pk)[0])
+
+
+class KeywordIndexTestCase(AppointmentDataTestCase):
+    "Cached lookup of timelines by keyword."
+
+    def setUp(self):
+        self.timeline = self.create_timeline(name='Test', slug='foo|Bar ')
+        self.other = self.create_timeline(name='Other', slug='baz')
+
+    def test_keywords(self):
+        "Each normalized keyword should map to its timeline."
+        index = get_keyword_index()
+        self.assertEqual(set(['foo', 'bar', 'baz']), set(index.keys()))
+        self.assertEqual(self.timeline, index['bar'])
+        self.assertEqual(self.other, get_timeline_for_keyword(' BAZ'))
+        self.assertEqual(None, get_timeline_for_keyword('ba'))
+
+    def test_shared_keyword(self):
+        "The oldest timeline should win when keywords are shared."
+        self.create_timeline(name='Newer', slug='foo')
+        self.assertEqual(self.timeline, get_timeline_for_keyword('foo'))
+
+    def test_cached(self):
+        "Lookups should not query the database once the index is built."
+        get_keyword_index()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.timeline, get_timeline_for_keyword('foo'))
+
+    def test_invalidate_on_save(self):
+        "Saving a timeline should drop the cached index."
+        get_keyword_index()
+        self.other.slug = 'qux'
+        self.other.save()
+        self.assertEqual(None, get_timeline_for_keyword('baz'))
+        self.assertEqual(self.other, get_timeline_for_keyword('qux'))
+
+    def test_invalidate_on_delete(self):
+        "Deleting a timeline should drop the cached index."
+        get_keyword_index()
+        self.other.delete()
+        self.assertEqual(None, get_timeline_for_keyword('baz'))
+
+
+class LastNotificationStatusTestCase(AppointmentDataTestCase):
+    "Status of the latest notification kept on each appointment."
+
+    def setUp(self):
+        self.appointment = self.create_appointment()
+
+    def get_status(self):
+        return Appointment.objects.get(pk=self.appointment.pk).last_notification_status
+
+    def test_no_notifications(self):
+        "Appointments without notifications should have no status."
+        self.assertEqual(None, self.get_status())
+
+    def test_saved(self):
+        "Saving a notification should record its status."
+        notification = self.create_notification(appointment=self.appointment, status=Notification.STATUS_SENT)
+        self.assertEqual(Notification.STATUS_SENT, self.get_status())
+        notification.status = Notification.STATUS_ERROR
+        notification.save()
+        self.assertEqual(Notification.STATUS_ERROR, self.get_status())
+
+    def test_confirmed(self):
+        "Confirming a notification should record the confirmed status."
+        notification = self.create_notification(appointment=self.appointment, status=Notification.STATUS_SENT)
+        notification.confirm()
+        self.assertEqual(Notification.STATUS_CONFIRMED, self.get_status())
+        notification.confirm(manual=True)
+        self.assertEqual(Notification.STATUS_MANUAL, self.get_status())
+
+    def test_deleted(self):
+        "Deleting a notification should fall back to the latest remaining one."
+        self.create_notification(appointment=self.appointment, status=Notification.STATUS_SENT)
+        latest = self.create_notification(appointment=self.appointment, status=Notification.STATUS_ERROR)
+        latest.delete()
+        self.assertEqual(Notification.STATUS_SENT, self.get_status())
+        Notification.objects.get().delete()
+        self.assertEqual(None, self.get_status())
+
+
+class AppointmentTestCase(AppointmentDataTestCase):
+    "Fields copied onto each appointment."
+
+    def test_copy_subscription_fields(self):
+        "New appointments should copy the timeline and connection of their subscription."
+        appointment = self.create_appointment()
+        self.assertEqual(appointment.subscription.timeline_id, appointment.timeline_id)
+        self.assertEqual(appointment.subscription.connection_id, appointment.connection_id)
+
+    def test_change_subscription(self):
+        "Moving an appointment to another subscription should copy its fields again."
+        appointment = self.create_appointment()
+        appointment.subscription = self.create_timeline_subscription()
+        appointment.save()
+        appointment = Appointment.objects.get(pk=appointment.pk)
+        self.assertEqual(appointment.subscription.timeline_id, appointment.timeline_id)
+        self.assertEqual(appointment.subscription.connection_id, appointment.connection_id)
+
+    def test_subscription_changed(self):
+        "Changing the subscription should update the copies on its appointments."
+        appointment = self.create_appointment()
+        subscription = appointment.subscription
+        subscription.timeline = self.create_timeline()
+        subscription.connection = self.create_connection()
+        subscription.save()
+        appointment = Appointment.objects.get(pk=appointment.pk)
+        self.assertEqual(subscription.timeline_id, appointment.timeline_id)
+        self.assertEqual(subscription.connection_id, appointment.connection_id)
+
+
+class NotificationTestCase(AppointmentDataTestCase):
+    "Notifications of appointments."
+
+    def test_unicode(self):
+        "Sent notifications should include the time they were sent."
+        notification = self.create_notification()
+        self.assertTrue(notification.sent.isoformat() in unicode(notification))
+
+    def test_unicode_pending(self):
+        "Pending notifications have not been sent yet."
+        notification = self.create_notification(status=Notification.STATUS_PENDING, sent=None)
+        self.assertTrue(unicode(notification).startswith('Pending notification for '))
+
+
+class TimelineSubscriptionTestCase(AppointmentDataTestCase):
+    "Creating subscriptions without duplicating active ones."
+
+    def setUp(self):
+        self.timeline = self.create_timeline(name='Test', slug='foo')
+        self.connection = self.create_connection()
+
+    def get_subscription(self, **kwargs):
+        defaults = {'timeline': self.timeline, 'connection': self.connection, 'pin': 'bar'}
+        defaults.update(kwargs)
+        return TimelineSubscription(**defaults)
+
+    def test_insert(self):
+        "A new subscription should be inserted with a single query."
+        with self.assertNumQueries(1):
+            self.assertTrue(self.get_subscription().insert_unless_active())
+        subscription = TimelineSubscription.objects.get()
+        self.assertEqual(('bar', None), (subscription.pin, subscription.end))
+
+    def test_active(self):
+        "Subscriptions should not be inserted if one is active."
+        self.get_subscription().save()
+        self.assertFalse(self.get_subscription().insert_unless_active())
+        TimelineSubscription.objects.update(end=now() + timedelta(days=1))
+        self.assertFalse(self.get_subscription().insert_unless_active())
+        self.assertEqual(1, TimelineSubscription.objects.count())
+
+    def test_ended(self):
+        "Subscriptions should be inserted if the previous one has ended."
+        self.get_subscription(end=now() - timedelta(days=1)).save()
+        self.assertTrue(self.get_subscription().insert_unless_active())
+        self.assertEqual(2, TimelineSubscription.objects.count())
+
+    def test_other_pin(self):
+        "Subscriptions with other pins should not conflict."
+        self.get_subscription().save()
+        self.assertTrue(self.get_subscription(pin='baz').insert_unless_active())
+
+
+@unittest.skipUnless(db is not None and connection.vendor == 'sqlite', 'Requires South and SQLite.')
+class IndexUsageTestCase(AppointmentDataTestCase):
+    "The indexes from the migrations should be used for the frequent queries."
+
+    migrations = (
+        '0010_add_index_timelinesubscription_connection_timeline_pin',
+        '0011_add_index_notification_status_confirmed_sent',
+        '0012_add_index_appointment_subscription_status_date',
+        '0013_add_indexes_for_frequent_queries',
+        '0019_unique_active_subscription',
+    )
+
+    def setUp(self):
+        # The test database is created without running the migrations
+        for name in self.migrations:
+            import_module('appointments.migrations.%s' % name).Migration().forwards(None)
+
+    def tearDown(self):
+        # Index changes aren't rolled back with the test transaction
+        for name in reversed(self.migrations):
+            import_module('appointments.migrations.%s' % name).Migration().backwards(None)
+
+    def get_plan(self, sql, params):
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN %s' % sql, params)
+        return ' '.join([row[-1] for row in cursor.fetchall()])
+
+    def assertUsesIndex(self, queryset, table, columns):
+        sql, params = queryset.query.sql_with_params()
+        self.assertTrue(db.create_index_name(table, columns) in self.get_plan(sql, params))
+
+    def test_subscription_lookup(self):
+        "Active subscriptions should be found by connection, timeline and pin."
+        subscriptions = TimelineSubscription.objects.filter(
+            Q(end__gte=now()) | Q(end__isnull=True), connection=1, timeline=1, pin='foo')
+        self.assertUsesIndex(subscriptions, 'appointments_timelinesubscription',
+                             ['connection_id', 'timeline_id', 'pin', 'end'])
+
+    def test_active_subscription_partial_index(self):
+        "The partial index should cover lookups of subscriptions without an end."
+        subscriptions = TimelineSubscription.objects.filter(end__isnull=True, connection=1, timeline=1, pin='foo')
+        sql, params = subscriptions.query.sql_with_params()
+        table = connection.ops.quote_name('appointments_timelinesubscription')
+        # SQLite raises an error if the forced index can't be used for the query
+        sql = sql.replace('FROM %s' % table, 'FROM %s INDEXED BY appointments_timelinesubscription_active' % table)
+        self.assertTrue('appointments_timelinesubscription_active' in self.get_plan(sql, params))
+
+    def test_active_subscription_unique(self):
+        "Only one open-ended subscription should be allowed per connection, timeline and pin."
+        subscription = self.create_timeline_subscription(pin='foo')
+        try:
+            self.create_timeline_subscription(
+                timeline=subscription.timeline, connection=subscription.connection, pin='foo', end=now())
+            self.assertRaises(IntegrityError, self.create_timeline_subscription,
+                              timeline=subscription.timeline, connection=subscription.connection, pin='foo')
+        finally:
+            # The index changes in tearDown commit the test transaction
+            subscription.timeline.delete()
+            subscription.connection.delete()
+            subscription.connection.backend.delete()
+
+    def test_appointment_range(self):
+        "Appointments should be found by date and status."
+        today = now().date()
+        appointments = Appointment.objects.filter(date__range=(today, today), status=Appointment.STATUS_DEFAULT)
+        self.assertUsesIndex(appointments, 'appointments_appointment', ['date', 'status'])
+
+    def test_notification_lookup(self):
+        "Notifications should be found by appointment and status."
+        notifications = Notification.objects.filter(
+            appointment=1, status__in=[Notification.STATUS_PENDING, Notification.STATUS_ERROR])
+        self.assertUsesIndex(notifications, 'appointments_notification', ['appointment_id', 'status'])
@@ -1,9 +1,29 @@
 from __future__ import unicode_literals
 
 import datetime
+from StringIO import StringIO
 
-from .base import AppointmentDataTestCase, Appointment, Milestone, Notification, now
-from ..tasks import generate_appointments, send_appointment_notifications, APPT_REMINDER
+from django.core.cache import get_cache
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone, translation, unittest
+from django.utils.functional import lazy
+try:
+    import pytz
+except ImportError:  # pytz is optional
+    pytz = None
+
+from rapidsms.models import Contact
+from rapidsms.tests.harness.backend import MockBackend
+
+from .. import tasks
+from ..ratelimit import SharedRateLimiter, get_rate_limiters
+from ..windows import SendWindow, get_send_windows
+from .base import AppointmentDataTestCase, Appointment, Milestone, Notification, TimelineSubscription, now
+from ..tasks import (generate_appointments, generate_appointments_parallel, combine_generation_counts,
+                     send_appointment_notifications, send_pending_notifications, APPT_REMINDER, _get_shard_ranges, _insert_ignore,
+                     _claim_appointments, _iter_chunks, _render_reminders,
+                     get_max_lateness)
 
 
 class GenerateAppointmentsTestCase(AppointmentDataTestCase):
@@ -31,7 +51,7 @@ class GenerateAppointmentsTestCase(AppointmentDataTestCase):
             milestone = Milestone.objects.get(offset=offset)
             self.create_appointment(subscription=self.sub, date=date, milestone=milestone)
         self.assertEqual(5, Appointment.objects.filter(subscription__connection=self.cnx).count())
-        generate_appointments()
+        self.assertEqual({'scanned': 1, 'created': 0}, generate_appointments())
         self.assertEqual(5, Appointment.objects.filter(subscription__connection=self.cnx).count())
 
     def test_generate_appointments_out_of_range(self):
@@ -57,10 +77,410 @@ class GenerateAppointmentsTestCase(AppointmentDataTestCase):
         generate_appointments(30)
         self.assertEqual(5, Appointment.objects.all().count())
 
+    def test_generate_appointments_counts(self):
+        "The task should report the number of subscriptions scanned and appointments created"
+        self.create_timeline_subscription(timeline=self.timeline)
+        self.assertEqual({'scanned': 2, 'created': 8}, generate_appointments())
+        self.assertEqual({'scanned': 0, 'created': 0}, generate_appointments())
+        self.assertEqual({'scanned': 2, 'created': 0}, generate_appointments(rebuild=True))
+
+    def test_generate_appointments_batched_queries(self):
+        "The number of queries should not grow with the number of subscriptions"
+        for i in range(4):
+            self.create_timeline_subscription(timeline=self.timeline)
+        # Milestones, subscriptions, a single INSERT and the watermark UPDATE
+        with self.assertNumQueries(4):
+            generate_appointments()
+        self.assertEqual(20, Appointment.objects.all().count())
+
+    def test_generate_appointments_keyset_chunks(self):
+        "Subscriptions should be fetched one bounded chunk at a time"
+        for i in range(4):
+            self.create_timeline_subscription(timeline=self.timeline)
+        # Milestones, a SELECT and watermark UPDATE per chunk of 2 subscriptions
+        # and an INSERT per 2 of the 20 appointments
+        with self.assertNumQueries(1 + 3 * 2 + 10):
+            generate_appointments(batch_size=2)
+        chunks = list(_iter_chunks(TimelineSubscription.objects.all(), 2, 'start'))
+        self.assertEqual([2, 2, 1], [len(chunk) for chunk in chunks])
+        ids = [row[0] for chunk in chunks for row in chunk]
+        self.assertEqual(sorted(ids), ids)
+
+    def test_generate_appointments_batch_size(self):
+        "Subscriptions should be processed in batches of the given size"
+        for i in range(4):
+            self.create_timeline_subscription(timeline=self.timeline)
+        self.assertEqual({'scanned': 5, 'created': 20}, generate_appointments(batch_size=2))
+        self.assertEqual(20, Appointment.objects.all().count())
+
+    def test_generate_appointments_id_range(self):
+        "The task should only generate appointments for subscriptions within the id range"
+        other = self.create_timeline_subscription(timeline=self.timeline)
+        self.assertEqual({'scanned': 1, 'created': 4}, generate_appointments(min_id=other.pk))
+        self.assertEqual(4, Appointment.objects.filter(subscription=other).count())
+        self.assertEqual({'scanned': 1, 'created': 4}, generate_appointments(max_id=self.sub.pk))
+        self.assertEqual(4, Appointment.objects.filter(subscription=self.sub).count())
+
+    def test_generate_appointments_watermark(self):
+        "The task should record the last date appointments were generated through"
+        generate_appointments()
+        sub = TimelineSubscription.objects.get(pk=self.sub.pk)
+        self.assertEqual(datetime.date.today() + datetime.timedelta(days=14), sub.generated_through)
+
+    def test_generate_appointments_incremental(self):
+        "Only the days which entered the window since the previous run should be computed"
+        generate_appointments()
+        Appointment.objects.all().delete()
+        yesterday_end = datetime.date.today() + datetime.timedelta(days=13)
+        TimelineSubscription.objects.update(generated_through=yesterday_end)
+        self.assertEqual({'scanned': 1, 'created': 1}, generate_appointments())
+        appt = Appointment.objects.get(subscription=self.sub)
+        self.assertEqual(14, appt.milestone.offset)
+
+    def test_generate_appointments_rebuild(self):
+        "Rebuilding should compute the full window regardless of previous runs"
+        generate_appointments()
+        Appointment.objects.all().delete()
+        self.assertEqual({'scanned': 0, 'created': 0}, generate_appointments())
+        self.assertEqual({'scanned': 1, 'created': 4}, generate_appointments(rebuild=True))
+
+    def test_generate_appointments_longer_window(self):
+        "A longer window than the previous run should generate the extra days"
+        generate_appointments()
+        self.assertEqual({'scanned': 1, 'created': 1}, generate_appointments(30))
+        self.assertEqual(5, Appointment.objects.filter(subscription=self.sub).count())
+
+    def test_milestone_change_resets_watermark(self):
+        "Saving a milestone should reset the watermark for the timeline's subscriptions"
+        generate_appointments()
+        self.create_milestone(name='2 day(s)', offset=2, timeline=self.timeline)
+        sub = TimelineSubscription.objects.get(pk=self.sub.pk)
+        self.assertEqual(None, sub.generated_through)
+        self.assertEqual({'scanned': 1, 'created': 1}, generate_appointments())
+
+    def test_generate_appointments_stale_index(self):
+        "Milestones missing from the cached index of the worker should still be generated"
+        generate_appointments()
+        tasks.get_milestone_index(self.timeline.pk)
+        # As if saved in the admin by another process with its own cache
+        Milestone.objects.bulk_create([Milestone(name='2 day(s)', offset=2, timeline=self.timeline)])
+        TimelineSubscription.objects.update(generated_through=None)
+        generate_appointments()
+        self.assertEqual(5, Appointment.objects.filter(subscription__connection=self.cnx).count())
+
+    def test_generate_appointments_command(self):
+        "The management command should run the task"
+        stdout = StringIO()
+        call_command('generate_appointments', days=30, stdout=stdout)
+        self.assertEqual(5, Appointment.objects.all().count())
+        self.assertIn('created 5 appointment(s)', stdout.getvalue())
+        Appointment.objects.all().delete()
+        call_command('generate_appointments', days=30, rebuild=True, stdout=StringIO())
+        self.assertEqual(5, Appointment.objects.all().count())
+
+    def test_generate_appointments_in_database(self):
+        "The task should generate the appointments with a single SQL statement"
+        self.create_timeline_subscription(timeline=self.timeline)
+        self.assertEqual({'scanned': 2, 'created': 8}, generate_appointments(in_database=True))
+        python_dates = sorted(Appointment.objects.values_list('subscription', 'milestone', 'date'))
+        self.assertEqual({'scanned': 0, 'created': 0}, generate_appointments(in_database=True))
+        Appointment.objects.all().delete()
+        generate_appointments(rebuild=True)
+        self.assertEqual(python_dates, sorted(Appointment.objects.values_list('subscription', 'milestone', 'date')))
+
+    def test_generate_appointments_copies(self):
+        "Generated appointments should copy the timeline and connection of their subscription"
+        expected = set([(self.sub.pk, self.timeline.pk, self.cnx.pk)])
+        for in_database in (False, True):
+            Appointment.objects.all().delete()
+            generate_appointments(rebuild=True, in_database=in_database)
+            copies = Appointment.objects.values_list('subscription', 'timeline', 'connection')
+            self.assertEqual(expected, set(copies))
+
+    def test_generate_appointments_in_database_queries(self):
+        "The number of queries should not depend on the number of subscriptions"
+        for i in range(4):
+            self.create_timeline_subscription(timeline=self.timeline)
+        # Count, INSERT ... SELECT and the watermark UPDATE
+        with self.assertNumQueries(3):
+            generate_appointments(in_database=True)
+        self.assertEqual(20, Appointment.objects.all().count())
+
+    def test_generate_appointments_in_database_already_exists(self):
+        "Existing appointments should not be created again"
+        milestone = Milestone.objects.get(offset=1)
+        date = self.sub.start.date() + datetime.timedelta(days=1)
+        self.create_appointment(subscription=self.sub, date=date, milestone=milestone)
+        self.assertEqual({'scanned': 1, 'created': 3}, generate_appointments(in_database=True))
+        self.assertEqual(4, Appointment.objects.all().count())
+
+    def test_generate_appointments_in_database_incremental(self):
+        "Only the days which entered the window since the previous run should be computed"
+        generate_appointments(in_database=True)
+        Appointment.objects.all().delete()
+        yesterday_end = datetime.date.today() + datetime.timedelta(days=13)
+        TimelineSubscription.objects.update(generated_through=yesterday_end)
+        self.assertEqual({'scanned': 1, 'created': 1}, generate_appointments(in_database=True))
+        self.assertEqual(14, Appointment.objects.get().milestone.offset)
+        self.assertEqual({'scanned': 1, 'created': 3}, generate_appointments(in_database=True, rebuild=True))
+
+    def test_generate_appointments_in_database_id_range(self):
+        "Only subscriptions within the id range should be handled"
+        other = self.create_timeline_subscription(timeline=self.timeline)
+        self.assertEqual({'scanned': 1, 'created': 4}, generate_appointments(in_database=True, min_id=other.pk))
+        self.assertEqual(4, Appointment.objects.filter(subscription=other).count())
+
+    def test_insert_ignore(self):
+        "Rows violating the unique constraint should be skipped"
+        milestone = Milestone.objects.get(offset=1)
+        date = datetime.date.today()
+        self.create_appointment(subscription=self.sub, date=date, milestone=milestone)
+        appts = [
+            Appointment(subscription=self.sub, milestone=milestone, date=date + datetime.timedelta(days=i))
+            for i in range(3)
+        ]
+        self.assertEqual(2, _insert_ignore(appts, batch_size=2))
+        self.assertEqual(3, Appointment.objects.filter(subscription=self.sub).count())
+
+    def test_insert_ignore_savepoints(self):
+        "Databases without an insert ignore statement should skip conflicts row by row"
+        milestone = Milestone.objects.get(offset=1)
+        date = datetime.date.today()
+        self.create_appointment(subscription=self.sub, date=date, milestone=milestone)
+        appts = [
+            Appointment(subscription=self.sub, milestone=milestone, date=date + datetime.timedelta(days=i))
+            for i in range(3)
+        ]
+        original = tasks._get_insert_ignore_sql
+        tasks._get_insert_ignore_sql = lambda: None
+        try:
+            self.assertEqual(2, _insert_ignore(appts, batch_size=2))
+            # The database mode falls back to inserting from Python
+            self.assertEqual({'scanned': 1, 'created': 3}, generate_appointments(in_database=True))
+        finally:
+            tasks._get_insert_ignore_sql = original
+        self.assertEqual(6, Appointment.objects.filter(subscription=self.sub).count())
+
+    def test_insert_ignore_postgresql_version(self):
+        "ON CONFLICT should only be used from PostgreSQL 9.5"
+        class FakeConnection(object):
+            vendor = 'postgresql'
+            pg_version = 90400
+        original = tasks.connection
+        tasks.connection = FakeConnection()
+        try:
+            self.assertEqual(None, tasks._get_insert_ignore_sql())
+            tasks.connection.pg_version = 90500
+            self.assertEqual(tasks.INSERT_IGNORE_SQL['postgresql'], tasks._get_insert_ignore_sql())
+        finally:
+            tasks.connection = original
+
+
+class GenerateAppointmentsParallelTestCase(AppointmentDataTestCase):
+    "Task to fan out appointment generation by subscription id range"
+
+    def setUp(self):
+        self.timeline = self.create_timeline(name='Test', slug='foo')
+        for offset in [1, 3, 7, 14, 30]:
+            self.create_milestone(name='{0} day(s)'.format(offset), offset=offset, timeline=self.timeline)
+        self.subs = [self.create_timeline_subscription(timeline=self.timeline) for i in range(5)]
+        self.app = generate_appointments_parallel.app
+        self.eager = self.app.conf.CELERY_ALWAYS_EAGER
+        self.app.conf.CELERY_ALWAYS_EAGER = True
+
+    def tearDown(self):
+        self.app.conf.CELERY_ALWAYS_EAGER = self.eager
+
+    def test_shard_ranges(self):
+        "Active subscription ids should be split into contiguous ranges"
+        first, last = self.subs[0].pk, self.subs[-1].pk
+        ranges = _get_shard_ranges(2)
+        self.assertEqual([(first, first + 2), (first + 3, last)], ranges)
+        self.assertEqual([(first, last)], _get_shard_ranges(1))
+        self.assertEqual(5, len(_get_shard_ranges(10)))
+
+    def test_shard_ranges_no_subscriptions(self):
+        "No ranges should be returned without active subscriptions"
+        self.subs[0].timeline.subscribers.update(end=now() - datetime.timedelta(days=1))
+        self.assertEqual([], _get_shard_ranges(2))
+        self.assertEqual(None, generate_appointments_parallel())
+
+    def test_combine_counts(self):
+        "Counts from each shard should be summed"
+        results = [{'scanned': 2, 'created': 5}, {'scanned': 3, 'created': 0}]
+        self.assertEqual({'scanned': 5, 'created': 5}, combine_generation_counts(results))
+
+    def test_generate_appointments_parallel(self):
+        "Every shard should generate the appointments for its subscriptions"
+        generate_appointments_parallel(shards=3)
+        self.assertEqual(20, Appointment.objects.all().count())
+        for sub in self.subs:
+            self.assertEqual(4, sub.appointments.count())
+
+
+class FakeClock(object):
+    "Clock which only moves forward when slept."
+
+    def __init__(self):
+        self.time = 0.0
+
+    def __call__(self):
+        return self.time
+
+    def sleep(self, seconds):
+        self.time += seconds
+
+
+class SendWindowTestCase(TestCase):
+    "Daily windows for sending reminders"
+
+    def setUp(self):
+        self.day = datetime.datetime(2013, 3, 1)
+
+    def at(self, hour, minute=0, days=0):
+        return self.day + datetime.timedelta(days=days, hours=hour, minutes=minute)
+
+    def test_is_open(self):
+        "The window should be open between its start and end"
+        window = SendWindow('08:00', '18:00')
+        self.assertFalse(window.is_open(self.at(7, 59)))
+        self.assertTrue(window.is_open(self.at(8)))
+        self.assertTrue(window.is_open(self.at(17, 59)))
+        self.assertFalse(window.is_open(self.at(18)))
+
+    def test_wraps_midnight(self):
+        "Windows ending before they start should be open overnight"
+        window = SendWindow('22:00', '02:00')
+        self.assertTrue(window.is_open(self.at(23)))
+        self.assertTrue(window.is_open(self.at(1)))
+        self.assertFalse(window.is_open(self.at(12)))
+        self.assertEqual(self.at(2, days=1), window.closes(self.at(23)))
+
+    def test_all_day(self):
+        "Windows starting and ending at the same time should always be open"
+        window = SendWindow('00:00', '00:00')
+        self.assertTrue(window.is_open(self.at(3)))
+        self.assertEqual(self.at(0, days=1), window.closes(self.at(3)))
+
+    def test_next_open(self):
+        "Closed windows should open at their next start"
+        window = SendWindow('08:00', '18:00')
+        self.assertEqual(self.at(8), window.next_open(self.at(6)))
+        self.assertEqual(self.at(9), window.next_open(self.at(9)))
+        self.assertEqual(self.at(8, days=1), window.next_open(self.at(19)))
+
+    def test_slots(self):
+        "The remaining slots of the next window should be listed"
+        window = SendWindow('08:00', '09:00', slot=20)
+        self.assertEqual([self.at(8), self.at(8, 20), self.at(8, 40)], window.get_slots(self.at(6)))
+        self.assertEqual([self.at(8, 30), self.at(8, 50)], window.get_slots(self.at(8, 30)))
+
+    def test_spread(self):
+        "Messages should be spread evenly over the slots"
+        window = SendWindow('08:00', '09:00', slot=20)
+        self.assertEqual([self.at(8), self.at(8), self.at(8, 20), self.at(8, 40)], window.spread(4, self.at(6)))
+        self.assertEqual([self.at(8), self.at(8, 20)], window.spread(2, self.at(6)))
+
+    def test_get_send_windows(self):
+        "Windows should be built for each name"
+        windows = get_send_windows({'foo': ('08:00', '18:00')}, slot=30)
+        self.assertEqual(datetime.time(8), windows['foo'].start)
+        self.assertEqual(datetime.timedelta(minutes=30), windows['foo'].slot)
+        self.assertEqual(None, windows['foo'].zone)
+
+    @unittest.skipUnless(pytz is not None, 'Requires pytz.')
+    def test_get_send_windows_zone(self):
+        "Windows can be given their own time zone"
+        windows = get_send_windows({'foo': ('08:00', '18:00', 'Africa/Nairobi')})
+        self.assertEqual(pytz.timezone('Africa/Nairobi'), windows['foo'].zone)
+
+    def in_zone(self, zone, hour, days=0):
+        "The server time for the hour in the given zone."
+        when = pytz.timezone(zone).localize(self.at(hour, days=days))
+        return timezone.make_naive(when, timezone.get_current_timezone())
+
+    @unittest.skipUnless(pytz is not None, 'Requires pytz.')
+    def test_zone(self):
+        "Windows with a time zone should be open during its hours"
+        window = SendWindow('08:00', '18:00', zone='Africa/Nairobi')
+        self.assertFalse(window.is_open(self.in_zone('Africa/Nairobi', 7)))
+        self.assertTrue(window.is_open(self.in_zone('Africa/Nairobi', 9)))
+        self.assertEqual(self.in_zone('Africa/Nairobi', 8), window.next_open(self.in_zone('Africa/Nairobi', 6)))
+        self.assertEqual(self.in_zone('Africa/Nairobi', 8, days=1),
+                         window.next_open(self.in_zone('Africa/Nairobi', 19)))
+        self.assertEqual(self.day.date(), window.get_local_date(self.in_zone('Africa/Nairobi', 23)))
+
+    @unittest.skipUnless(pytz is not None, 'Requires pytz.')
+    def test_zone_aware(self):
+        "Windows with a time zone should also handle aware datetimes"
+        window = SendWindow('08:00', '18:00', zone='Africa/Nairobi')
+        nairobi = pytz.timezone('Africa/Nairobi')
+        with self.settings(USE_TZ=True):
+            self.assertFalse(window.is_open(nairobi.localize(self.at(7))))
+            self.assertEqual(nairobi.localize(self.at(8)), window.next_open(nairobi.localize(self.at(6))))
+
+
+class SharedRateLimiterTestCase(TestCase):
+    "Rate limiter for outbound reminders"
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = get_cache('django.core.cache.backends.locmem.LocMemCache', LOCATION='ratelimit')
+        self.cache.clear()
+
+    def get_limiter(self, rate, capacity=None, name='test'):
+        return SharedRateLimiter(name, rate, capacity, cache=self.cache, clock=self.clock, sleep=self.clock.sleep)
+
+    def test_burst(self):
+        "Messages up to the capacity should be sent without waiting"
+        limiter = self.get_limiter(10)
+        self.assertEqual(0, limiter.consume(10))
+        self.assertEqual(0, self.clock())
+
+    def test_rate(self):
+        "Messages beyond the capacity should be spread out at the rate"
+        limiter = self.get_limiter(10)
+        limiter.consume(10)
+        for i in range(20):
+            limiter.consume()
+        self.assertAlmostEqual(2.0, self.clock())
+
+    def test_refill(self):
+        "The capacity should be available again in each period"
+        limiter = self.get_limiter(10, 5)
+        limiter.consume(5)
+        self.clock.sleep(60)
+        self.assertEqual(0, limiter.consume(5))
+        self.assertAlmostEqual(0.5, limiter.consume(5))
+
+    def test_shared(self):
+        "Limiters for the same backend should share the rate through the cache"
+        self.get_limiter(10).consume(10)
+        self.assertAlmostEqual(1.0, self.get_limiter(10).consume(1))
+        self.assertEqual(0, self.get_limiter(10, name='other').consume(10))
+
+    def test_larger_than_capacity(self):
+        "Requests larger than the capacity should wait for a period of their own"
+        limiter = self.get_limiter(10)
+        limiter.consume(1)
+        self.assertAlmostEqual(1.0, limiter.consume(15))
+
+    def test_get_rate_limiters(self):
+        "Rates can be given as messages per second or as (rate, capacity) pairs"
+        limiters = get_rate_limiters(
+            {'a': 5, 'b': (10, 20)}, cache=self.cache, clock=self.clock, sleep=self.clock.sleep)
+        self.assertEqual((5, 5), (limiters['a'].rate, limiters['a'].capacity))
+        self.assertEqual((10, 20), (limiters['b'].rate, limiters['b'].capacity))
+
 
 class SendAppointmentNotificationsTestCase(AppointmentDataTestCase):
     "Task to send notifications for upcoming Appointments"
 
+    backends = {
+        'mockbackend': {'ENGINE': MockBackend},
+        'otherbackend': {'ENGINE': MockBackend},
+    }
+
     def setUp(self):
         self.backend = self.create_backend(name='mockbackend')
         self.cnx = self.create_connection(backend=self.backend)
@@ -107,7 +527,549 @@ class SendAppointmentNotificationsTestCase(AppointmentDataTestCase):
         self.assertEqual(0, Notification.objects.all().count())
         send_appointment_notifications()
         self.assertEqual(2, Notification.objects.all().count())
+        # Reminders with the same text are sent together
+        self.assertEqual(1, len(self.outbound))
+        self.assertEqual(set([self.cnx, self.cnx2]), set(self.outbound[0].connections))
+
+    def test_send_notifications_multiple_subscriptions(self):
+        "Appointments should be sent once even if the connection has several subscriptions"
+        self.create_timeline_subscription(connection=self.cnx, timeline=self.timeline)
+        self.create_timeline_subscription(connection=self.cnx)
+        send_appointment_notifications()
+        self.assertEqual(1, Notification.objects.all().count())
+        self.assertEqual(1, len(self.outbound))
+
+    def test_send_notifications_ended_subscription(self):
+        "No notifications should be sent for subscriptions which have ended"
+        self.subscription.end = now() - datetime.timedelta(days=1)
+        self.subscription.save()
+        self.create_timeline_subscription(connection=self.cnx, timeline=self.timeline)
+        send_appointment_notifications()
+        self.assertEqual(0, Notification.objects.all().count())
+        self.assertEqual(0, len(self.outbound))
+
+    def test_send_notifications_last_status(self):
+        "The status of the latest reminder should be recorded on the appointment"
+        send_appointment_notifications()
+        appointment = Appointment.objects.get(pk=self.appointment.pk)
+        self.assertEqual(Notification.STATUS_SENT, appointment.last_notification_status)
+
+    def test_send_notifications_last_status_failed(self):
+        "Reminders which fail to send should be recorded on the appointment"
+        restore = self.fail_send()
+        try:
+            send_appointment_notifications()
+        finally:
+            restore()
+        appointment = Appointment.objects.get(pk=self.appointment.pk)
+        self.assertEqual(Notification.STATUS_ERROR, appointment.last_notification_status)
+        # The appointment isn't queued again
+        self.assertEqual({'queued': 0, 'sent': 0, 'failed': 0}, send_appointment_notifications())
+
+    def test_send_notifications_queries(self):
+        "Connections should be loaded with the appointments"
+        for i in range(3):
+            cnx = self.create_connection(backend=self.backend)
+            sub = self.create_timeline_subscription(connection=cnx, timeline=self.timeline)
+            self.create_appointment(subscription=sub)
+        # Queue: claim (SELECT and UPDATE), SELECT of the claimed appointments, a single
+        # INSERT of the pending notifications, the UPDATE of the appointments' last
+        # notification status, the empty claim and releasing the claims
+        # Send: the two UPDATEs failing unsendable reminders, claim, SELECT of the
+        # notifications, a single UPDATE of their status and one of the appointments,
+        # the empty claim and releasing the claims
+        with self.assertNumQueries(16):
+            send_appointment_notifications()
+        self.assertEqual(1, len(self.outbound))
+        self.assertEqual(4, len(self.outbound[0].connections))
+
+    def test_send_notifications_batch_size(self):
+        "Connections should be split into batches of the given size"
+        for i in range(4):
+            cnx = self.create_connection(backend=self.backend)
+            sub = self.create_timeline_subscription(connection=cnx, timeline=self.timeline)
+            self.create_appointment(subscription=sub)
+        send_appointment_notifications(batch_size=2)
+        self.assertEqual(5, Notification.objects.all().count())
+        self.assertEqual([2, 2, 1], [len(msg.connections) for msg in self.outbound])
+
+    def test_send_notifications_batch_queries(self):
+        "Notifications should be written with one INSERT per batch"
+        for i in range(4):
+            cnx = self.create_connection(backend=self.backend)
+            sub = self.create_timeline_subscription(connection=cnx, timeline=self.timeline)
+            self.create_appointment(subscription=sub)
+        with self.assertNumQueries(20):
+            send_appointment_notifications(batch_size=2)
+
+    def fail_send(self):
+        "Make every send fail until the returned function is called."
+        def fail(*args, **kwargs):
+            raise Exception('Error!')
+        original = tasks.send
+        tasks.send = fail
+        def restore():
+            tasks.send = original
+        return restore
+
+    def test_send_notifications_error(self):
+        "Notifications should be marked as errors when the batch cannot be sent"
+        restore = self.fail_send()
+        try:
+            result = send_appointment_notifications()
+        finally:
+            restore()
+        self.assertEqual({'queued': 1, 'sent': 0, 'failed': 1}, result)
+        notification = Notification.objects.get(appointment=self.appointment)
+        self.assertEqual(Notification.STATUS_ERROR, notification.status)
+        self.assertEqual(1, notification.attempts)
+        self.assertTrue(notification.next_attempt > now())
+
+    def test_send_notifications_retry(self):
+        "Failed reminders should be retried once the backoff has passed"
+        restore = self.fail_send()
+        try:
+            send_appointment_notifications()
+        finally:
+            restore()
+        # Not retried before the backoff has passed
+        self.assertEqual({'sent': 0, 'failed': 0}, send_pending_notifications())
+        Notification.objects.update(next_attempt=now() - datetime.timedelta(seconds=1))
+        self.assertEqual({'sent': 1, 'failed': 0}, send_pending_notifications())
+        self.assertEqual(1, len(self.outbound))
+        notification = Notification.objects.get(appointment=self.appointment)
+        self.assertEqual(Notification.STATUS_SENT, notification.status)
+        self.assertEqual(2, notification.attempts)
+
+    def test_send_notifications_backoff(self):
+        "The delay between attempts should double after each failure"
+        restore = self.fail_send()
+        try:
+            send_appointment_notifications()
+            first = Notification.objects.get().next_attempt - now()
+            Notification.objects.update(next_attempt=now())
+            send_pending_notifications()
+            second = Notification.objects.get().next_attempt - now()
+        finally:
+            restore()
+        self.assertAlmostEqual(60, first.seconds, delta=5)
+        self.assertAlmostEqual(120, second.seconds, delta=5)
+
+    def get_closed_window(self):
+        "Window of an hour opening two hours from now."
+        current = now()
+        start = (current + datetime.timedelta(hours=2)).time()
+        end = (current + datetime.timedelta(hours=3)).time()
+        return start, end, SendWindow(start, end).next_open(current)
+
+    def postpone_appointments(self):
+        "Date the appointments after any window of the next day opens."
+        Appointment.objects.update(date=now().date() + datetime.timedelta(days=1))
+
+    def freeze_noon(self):
+        "Make the tasks run at noon until the returned function is called."
+        noon = datetime.datetime.combine(now().date(), datetime.time(12))
+        original = tasks.now
+        tasks.now = lambda: noon
+        def restore():
+            tasks.now = original
+        return restore
+
+    def test_send_notifications_timeline_window(self):
+        "Reminders should wait for the send window of their timeline"
+        start, end, opens = self.get_closed_window()
+        self.postpone_appointments()
+        with self.settings(APPOINTMENTS_TIMELINE_SEND_WINDOWS={self.timeline.slug: (start, end)}):
+            self.assertEqual({'queued': 1, 'sent': 0, 'failed': 0}, send_appointment_notifications())
+        self.assertEqual(0, len(self.outbound))
+        notification = Notification.objects.get()
+        self.assertEqual(Notification.STATUS_PENDING, notification.status)
+        self.assertEqual(opens, notification.next_attempt)
+
+    def test_send_notifications_backend_window(self):
+        "Reminders should wait for the send window of their backend"
+        start, end, opens = self.get_closed_window()
+        self.postpone_appointments()
+        with self.settings(APPOINTMENTS_BACKEND_SEND_WINDOWS={'mockbackend': (start, end)}):
+            self.assertEqual({'queued': 1, 'sent': 0, 'failed': 0}, send_appointment_notifications())
+        self.assertEqual(opens, Notification.objects.get().next_attempt)
+
+    def test_send_notifications_window_keyword(self):
+        "Timeline windows should match any keyword of the timeline"
+        start, end, opens = self.get_closed_window()
+        self.postpone_appointments()
+        self.timeline.slug = 'foo|Bar'
+        self.timeline.save()
+        with self.settings(APPOINTMENTS_TIMELINE_SEND_WINDOWS={'bar': (start, end)}):
+            self.assertEqual({'queued': 1, 'sent': 0, 'failed': 0}, send_appointment_notifications())
+        self.assertEqual(opens, Notification.objects.get().next_attempt)
+
+    def test_send_notifications_window_after_appointment(self):
+        "Reminders should fail if the window doesn't open again before the appointment"
+        restore = self.freeze_noon()
+        try:
+            with self.settings(APPOINTMENTS_BACKEND_SEND_WINDOWS={'mockbackend': ('08:00', '09:00')}):
+                self.assertEqual({'queued': 0, 'sent': 0, 'failed': 0}, send_appointment_notifications())
+        finally:
+            restore()
+        notification = Notification.objects.get()
+        self.assertEqual((Notification.STATUS_FAILED, None), (notification.status, notification.next_attempt))
+        self.assertEqual(Notification.STATUS_FAILED, Appointment.objects.get().last_notification_status)
+
+    def test_send_notifications_window_precedence(self):
+        "The timeline window should be used over the backend window"
+        start, end, opens = self.get_closed_window()
+        windows = {
+            'APPOINTMENTS_TIMELINE_SEND_WINDOWS': {self.timeline.slug: ('00:00', '00:00')},
+            'APPOINTMENTS_BACKEND_SEND_WINDOWS': {'mockbackend': (start, end)},
+        }
+        with self.settings(**windows):
+            self.assertEqual({'queued': 1, 'sent': 1, 'failed': 0}, send_appointment_notifications())
+
+    def test_send_notifications_window_slots(self):
+        "Reminders should be spread over the slots of the window"
+        start, end, opens = self.get_closed_window()
+        for i in range(7):
+            cnx = self.create_connection(backend=self.backend)
+            sub = self.create_timeline_subscription(connection=cnx, timeline=self.timeline)
+            self.create_appointment(subscription=sub)
+        self.postpone_appointments()
+        with self.settings(APPOINTMENTS_BACKEND_SEND_WINDOWS={'mockbackend': (start, end)},
+                           APPOINTMENTS_SEND_SLOT_SIZE=15):
+            send_appointment_notifications()
+        slots = [opens + datetime.timedelta(minutes=15 * i) for i in range(4)]
+        attempts = Notification.objects.order_by('next_attempt').values_list('next_attempt', flat=True)
+        self.assertEqual([slot for slot in slots for i in range(2)], list(attempts))
+
+    def test_send_notifications_retry_window(self):
+        "Retries should wait for the send window to open"
+        self.postpone_appointments()
+        restore = self.fail_send()
+        try:
+            with self.settings(APPOINTMENTS_BACKEND_SEND_WINDOWS={'mockbackend': ('00:00', '00:00')}):
+                send_appointment_notifications()
+            start, end, opens = self.get_closed_window()
+            Notification.objects.update(next_attempt=now())
+            with self.settings(APPOINTMENTS_BACKEND_SEND_WINDOWS={'mockbackend': (start, end)}):
+                send_pending_notifications()
+        finally:
+            restore()
+        notification = Notification.objects.get()
+        self.assertEqual(Notification.STATUS_ERROR, notification.status)
+        self.assertEqual(opens, notification.next_attempt)
+
+    def test_send_notifications_retry_after_appointment(self):
+        "Retries should fail if the window doesn't open again before the appointment"
+        restore = self.fail_send()
+        restore_now = self.freeze_noon()
+        try:
+            self.assertEqual({'queued': 1, 'sent': 0, 'failed': 1}, send_appointment_notifications())
+            with self.settings(APPOINTMENTS_BACKEND_SEND_WINDOWS={'mockbackend': ('08:00', '09:00')}):
+                Notification.objects.update(next_attempt=tasks.now())
+                send_pending_notifications()
+        finally:
+            restore_now()
+            restore()
+        notification = Notification.objects.get()
+        self.assertEqual((Notification.STATUS_FAILED, None), (notification.status, notification.next_attempt))
+        self.assertEqual(2, notification.attempts)
+
+    def test_send_notifications_max_attempts(self):
+        "Reminders should be marked as failed after the maximum number of attempts"
+        restore = self.fail_send()
+        try:
+            with self.settings(APPOINTMENTS_SEND_MAX_ATTEMPTS=2):
+                send_appointment_notifications()
+                Notification.objects.update(next_attempt=now())
+                send_pending_notifications()
+                notification = Notification.objects.get()
+                self.assertEqual(Notification.STATUS_FAILED, notification.status)
+                self.assertEqual(2, notification.attempts)
+                self.assertEqual({'sent': 0, 'failed': 0}, send_pending_notifications())
+        finally:
+            restore()
+        # No new reminder is queued for the appointment
+        self.assertEqual({'queued': 0, 'sent': 0, 'failed': 0}, send_appointment_notifications())
+
+    def test_send_pending_notifications_ended_subscription(self):
+        "Pending reminders should not be sent after the subscription has ended"
+        self.create_notification(appointment=self.appointment, status=Notification.STATUS_PENDING, sent=None)
+        self.subscription.end = now() - datetime.timedelta(days=1)
+        self.subscription.save()
+        self.assertEqual({'sent': 0, 'failed': 0}, send_pending_notifications())
+        self.assertEqual(0, len(self.outbound))
+        self.assertEqual(Notification.STATUS_FAILED, Notification.objects.get().status)
+        self.assertEqual(Notification.STATUS_FAILED, Appointment.objects.get().last_notification_status)
+
+    def test_send_pending_notifications_past_appointment(self):
+        "Pending reminders for past appointments should be marked as failed"
+        self.create_notification(appointment=self.appointment, status=Notification.STATUS_ERROR,
+                                 next_attempt=now() - datetime.timedelta(days=3))
+        Appointment.objects.update(date=now().date() - datetime.timedelta(days=1))
+        self.assertEqual({'sent': 0, 'failed': 0}, send_pending_notifications())
+        notification = Notification.objects.get()
+        self.assertEqual((Notification.STATUS_FAILED, None), (notification.status, notification.next_attempt))
+
+    def test_send_pending_notifications_existing_error(self):
+        "Errors recorded before the outbox should be retried"
+        self.create_notification(appointment=self.appointment, status=Notification.STATUS_ERROR)
+        self.assertEqual({'sent': 1, 'failed': 0}, send_pending_notifications())
+        self.assertEqual(1, len(self.outbound))
+
+    def test_send_notifications_rate_limited(self):
+        "Batches for rate limited backends should not exceed the allowed burst"
+        for i in range(4):
+            cnx = self.create_connection(backend=self.backend)
+            sub = self.create_timeline_subscription(connection=cnx, timeline=self.timeline)
+            self.create_appointment(subscription=sub)
+        with self.settings(APPOINTMENTS_SEND_RATES={'mockbackend': (1000, 2)}):
+            send_appointment_notifications()
+        self.assertEqual(5, Notification.objects.all().count())
+        self.assertEqual([2, 2, 1], [len(msg.connections) for msg in self.outbound])
+
+    def test_send_notifications_concurrent(self):
+        "Batches sent from a thread pool should record one notification per appointment"
+        for i in range(9):
+            cnx = self.create_connection(backend=self.backend)
+            sub = self.create_timeline_subscription(connection=cnx, timeline=self.timeline)
+            self.create_appointment(subscription=sub)
+        result = send_appointment_notifications(batch_size=2, workers=3)
+        self.assertEqual({'queued': 10, 'sent': 10, 'failed': 0}, result)
+        self.assertEqual(5, len(self.outbound))
+        self.assertEqual(10, Notification.objects.filter(status=Notification.STATUS_SENT).count())
+        for appt in Appointment.objects.all():
+            self.assertEqual(1, appt.notifications.count())
+
+    def test_send_notifications_concurrent_errors(self):
+        "Failures in a worker thread should only mark that batch as errors"
+        other = self.create_connection(backend=self.create_backend(name='otherbackend'))
+        sub = self.create_timeline_subscription(connection=other, timeline=self.timeline)
+        failed = self.create_appointment(subscription=sub)
+        def fail_other(msg, connections):
+            if connections[0].backend.name == 'otherbackend':
+                raise Exception('Error!')
+            return original(msg, connections)
+        original = tasks.send
+        tasks.send = fail_other
+        try:
+            result = send_appointment_notifications(workers=2)
+        finally:
+            tasks.send = original
+        self.assertEqual({'queued': 2, 'sent': 1, 'failed': 1}, result)
+        self.assertEqual(Notification.STATUS_SENT, self.appointment.notifications.get().status)
+        self.assertEqual(Notification.STATUS_ERROR, failed.notifications.get().status)
+
+    def test_send_notifications_concurrent_connections(self):
+        "Each worker thread should close its database connection"
+        other = self.create_connection(backend=self.create_backend(name='otherbackend'))
+        self.create_appointment(subscription=self.create_timeline_subscription(connection=other, timeline=self.timeline))
+        closed = []
+        original = tasks.close_connection
+        tasks.close_connection = lambda: closed.append(True)
+        try:
+            send_appointment_notifications(workers=2)
+        finally:
+            tasks.close_connection = original
+        self.assertEqual(2, len(closed))
+
+    def test_send_notifications_claimed(self):
+        "Appointments claimed by another worker should be skipped"
+        Appointment.objects.filter(pk=self.appointment.pk).update(claim_token='other', claimed=now())
+        self.assertEqual({'queued': 0, 'sent': 0, 'failed': 0}, send_appointment_notifications())
+        self.assertEqual(0, len(self.outbound))
+        self.assertEqual('other', Appointment.objects.get(pk=self.appointment.pk).claim_token)
+
+    def test_send_notifications_stale_claim(self):
+        "Claims older than the timeout should be taken over"
+        claimed = now() - datetime.timedelta(hours=2)
+        Appointment.objects.filter(pk=self.appointment.pk).update(claim_token='other', claimed=claimed)
+        self.assertEqual({'queued': 1, 'sent': 1, 'failed': 0}, send_appointment_notifications())
+        self.assertEqual(1, len(self.outbound))
+
+    def test_send_notifications_release_claims(self):
+        "Claims should be released at the end of the run"
+        send_appointment_notifications()
+        appt = Appointment.objects.get(pk=self.appointment.pk)
+        self.assertEqual(('', None), (appt.claim_token, appt.claimed))
+
+    def test_claim_appointments(self):
+        "Claimed appointments should not be claimed again"
+        appts = Appointment.objects.all()
+        other = self.create_appointment(subscription=self.subscription, date=now() + datetime.timedelta(days=1))
+        token, last = _claim_appointments(appts, 1)
+        self.assertEqual([self.appointment], list(Appointment.objects.filter(claim_token=token)))
+        self.assertEqual((self.appointment.date, self.appointment.pk), last)
+        second, last = _claim_appointments(appts, 5)
+        self.assertEqual([other], list(Appointment.objects.filter(claim_token=second)))
+        self.assertEqual((None, None), _claim_appointments(appts, 5))
+
+    def test_claim_appointments_interleaved(self):
+        "Appointments handled by another worker after they were selected should not be claimed"
+        appts = Appointment.objects.filter(last_notification_status__isnull=True)
+        original = tasks.uuid
+
+        class InterleavedUUID(object):
+            "Let another worker queue the selected appointments before the claim."
+
+            def uuid4(self):
+                tasks.uuid = original
+                tasks._queue_reminders(appts, 10)
+                return original.uuid4()
+
+        tasks.uuid = InterleavedUUID()
+        try:
+            self.assertEqual(0, tasks._queue_reminders(appts, 10))
+        finally:
+            tasks.uuid = original
+        self.assertEqual(1, self.appointment.notifications.count())
+
+    def test_drain_outbox_interleaved(self):
+        "Reminders sent by another worker after they were selected should not be sent again"
+        self.create_notification(appointment=self.appointment, status=Notification.STATUS_PENDING, sent=None)
+        original = tasks.uuid
+
+        class InterleavedUUID(object):
+            "Let another worker send the selected reminders before the claim."
+
+            def uuid4(self):
+                tasks.uuid = original
+                send_pending_notifications()
+                return original.uuid4()
+
+        tasks.uuid = InterleavedUUID()
+        try:
+            self.assertEqual({'sent': 0, 'failed': 0}, send_pending_notifications())
+        finally:
+            tasks.uuid = original
+        self.assertEqual(1, len(self.outbound))
+
+    def test_queue_reminders_already_queued(self):
+        "Claimed appointments which already have a reminder should not be queued again"
+        self.create_notification(appointment=self.appointment, status=Notification.STATUS_PENDING, sent=None)
+        self.assertEqual(0, tasks._queue_reminders(Appointment.objects.all(), 10))
+        self.assertEqual(1, self.appointment.notifications.count())
+
+    def test_claim_appointments_after(self):
+        "Only appointments after the given date and id should be claimed"
+        appts = Appointment.objects.all()
+        other = self.create_appointment(subscription=self.subscription, date=now() + datetime.timedelta(days=1))
+        after = (self.appointment.date, self.appointment.pk)
+        token, last = _claim_appointments(appts, 5, after=after)
+        self.assertEqual([other], list(Appointment.objects.filter(claim_token=token)))
+        self.assertEqual(other.pk, last[1])
+        self.assertEqual((None, last), _claim_appointments(appts, 5, after=last))
+
+    def test_claim_appointments_soonest_first(self):
+        "Appointments should be claimed in order of date rather than id"
+        appts = Appointment.objects.all()
+        later = self.create_appointment(subscription=self.subscription, date=now() + datetime.timedelta(days=5))
+        sooner = self.create_appointment(subscription=self.subscription, date=now() + datetime.timedelta(days=2))
+        _claim_appointments(appts, 1)
+        token, last = _claim_appointments(appts, 1, after=(self.appointment.date, self.appointment.pk))
+        self.assertEqual([sooner], list(Appointment.objects.filter(claim_token=token)))
+        token, last = _claim_appointments(appts, 1, after=last)
+        self.assertEqual([later], list(Appointment.objects.filter(claim_token=token)))
+
+    def test_send_notifications_soonest_first(self):
+        "Reminders for sooner appointments should be sent first"
+        appointments = []
+        for days in (6, 2, 4):
+            cnx = self.create_connection(backend=self.backend)
+            sub = self.create_timeline_subscription(connection=cnx, timeline=self.timeline)
+            appointments.append(self.create_appointment(
+                subscription=sub, date=now() + datetime.timedelta(days=days)))
+        with self.settings(APPOINTMENTS_CLAIM_SIZE=2):
+            send_appointment_notifications()
+        connections = [msg.connections[0] for msg in self.outbound]
+        expected = [self.cnx] + [appt.subscription.connection for appt in sorted(appointments, key=lambda a: a.date)]
+        self.assertEqual(expected, connections)
+
+    def test_max_lateness(self):
+        "The lateness should be measured from the most overdue reminder in the outbox"
+        self.assertEqual(datetime.timedelta(0), get_max_lateness())
+        self.create_notification(appointment=self.appointment, status=Notification.STATUS_PENDING,
+                                 next_attempt=now() - datetime.timedelta(hours=1))
+        self.assertAlmostEqual(3600, get_max_lateness().seconds, delta=5)
+        Notification.objects.update(next_attempt=now() + datetime.timedelta(hours=1))
+        self.assertEqual(datetime.timedelta(0), get_max_lateness())
+
+    def test_max_lateness_unsendable(self):
+        "Reminders which can no longer be sent should not count as late"
+        self.create_notification(appointment=self.appointment, status=Notification.STATUS_PENDING,
+                                 next_attempt=now() - datetime.timedelta(days=3))
+        Appointment.objects.update(date=now().date() - datetime.timedelta(days=1))
+        self.assertEqual(datetime.timedelta(0), get_max_lateness())
+        Appointment.objects.update(date=now().date())
+        self.subscription.end = now() - datetime.timedelta(days=1)
+        self.subscription.save()
+        self.assertEqual(datetime.timedelta(0), get_max_lateness())
+
+    def test_send_notifications_claim_size(self):
+        "Due appointments should be claimed and sent in chunks"
+        for i in range(4):
+            cnx = self.create_connection(backend=self.backend)
+            sub = self.create_timeline_subscription(connection=cnx, timeline=self.timeline)
+            self.create_appointment(subscription=sub)
+        with self.settings(APPOINTMENTS_CLAIM_SIZE=2):
+            self.assertEqual({'queued': 5, 'sent': 5, 'failed': 0}, send_appointment_notifications())
+        self.assertEqual(3, len(self.outbound))
+        self.assertEqual(5, Notification.objects.all().count())
+
+    def test_send_notifications_grouped_by_text(self):
+        "Reminders with different text should be sent separately"
+        cnx = self.create_connection(backend=self.backend)
+        sub = self.create_timeline_subscription(connection=cnx, timeline=self.timeline)
+        later = self.create_appointment(subscription=sub, date=self.appointment.date + datetime.timedelta(days=1))
+        send_appointment_notifications()
+        self.assertEqual(2, len(self.outbound))
+        texts = dict((msg.connections[0], msg.text) for msg in self.outbound)
+        self.assertEqual(APPT_REMINDER % {'date': self.appointment.date}, texts[self.cnx])
+        self.assertEqual(APPT_REMINDER % {'date': later.date}, texts[cnx])
+
+    def test_send_notifications_contact_language(self):
+        "Reminders should be rendered in the language of the contact"
+        translated = []
+
+        def reminder():
+            translated.append(translation.get_language())
+            return '%s %%(date)s' % translation.get_language()
+
+        contact = Contact.objects.create(name='Test', language='es')
+        cnx = self.create_connection(backend=self.backend, contact=contact)
+        sub = self.create_timeline_subscription(connection=cnx, timeline=self.timeline)
+        other = self.create_appointment(subscription=sub, date=self.appointment.date)
+        original = tasks.APPT_REMINDER
+        tasks.APPT_REMINDER = lazy(reminder, unicode)()
+        try:
+            with self.settings(LANGUAGE_CODE='en'):
+                send_appointment_notifications()
+        finally:
+            tasks.APPT_REMINDER = original
+        texts = dict((msg.connections[0], msg.text) for msg in self.outbound)
+        self.assertEqual('en %s' % self.appointment.date, texts[self.cnx])
+        self.assertEqual('es %s' % other.date, texts[cnx])
+        # Each language is only activated once per run
+        self.assertEqual(['en', 'es'], sorted(translated))
+
+    def test_render_reminders_cached(self):
+        "Each (language, date) pair should only be rendered once"
+        today = now().date()
+        templates, messages = {}, {}
+        _render_reminders([('en', today), ('en', today)], templates, messages)
+        self.assertEqual({'en': unicode(APPT_REMINDER)}, templates)
+        self.assertEqual({('en', today): APPT_REMINDER % {'date': today}}, messages)
+        templates['en'] = 'changed %(date)s'
+        _render_reminders([('en', today)], templates, messages)
+        self.assertEqual(APPT_REMINDER % {'date': today}, messages[('en', today)])
+
+    def test_send_notifications_grouped_by_backend(self):
+        "Reminders for connections on different backends should be sent separately"
+        other = self.create_connection(backend=self.create_backend(name='otherbackend'))
+        sub = self.create_timeline_subscription(connection=other, timeline=self.timeline)
+        self.create_appointment(subscription=sub)
+        send_appointment_notifications()
         self.assertEqual(2, len(self.outbound))
+        self.assertEqual([1, 1], [len(msg.connections) for msg in self.outbound])
 
     def test_send_notifications_for_n_days(self):
         "The task should generate appointments when supplied N days as an argument"
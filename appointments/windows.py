@@ -0,0 +1,123 @@
+"Time of day windows for spreading outbound messages."
+
+import datetime
+
+from django.conf import settings
+from django.utils import timezone
+
+
+def _parse_time(value):
+    "Accept either a datetime.time or an 'HH:MM' string."
+    if isinstance(value, datetime.time):
+        return value
+    return datetime.datetime.strptime(value, '%H:%M').time()
+
+
+def _parse_zone(value):
+    "Accept either a tzinfo or the name of a time zone, which requires pytz."
+    if value is None or isinstance(value, datetime.tzinfo):
+        return value
+    import pytz
+    return pytz.timezone(value)
+
+
+class SendWindow(object):
+    """
+    Daily window from `start` to `end` in the time zone `zone`, or the current
+    time zone if it is None, divided into slots of `slot` minutes.
+
+    Windows which end before they start wrap past midnight and windows which
+    start and end at the same time are open all day.
+    """
+
+    def __init__(self, start, end, slot=15, zone=None):
+        self.start = _parse_time(start)
+        self.end = _parse_time(end)
+        self.slot = datetime.timedelta(minutes=slot)
+        self.zone = _parse_zone(zone)
+
+    def _to_local(self, when):
+        "Naive time in the zone of the window for the given datetime."
+        if timezone.is_naive(when):
+            if self.zone is None:
+                return when
+            when = timezone.make_aware(when, timezone.get_current_timezone())
+        return timezone.localtime(when, self.zone or timezone.get_current_timezone()).replace(tzinfo=None)
+
+    def _from_local(self, when):
+        "Convert a naive time in the zone of the window back to the form used by the models."
+        if self.zone is not None:
+            when = timezone.make_aware(when, self.zone)
+            if not settings.USE_TZ:
+                when = timezone.make_naive(when, timezone.get_current_timezone())
+        elif settings.USE_TZ:
+            when = timezone.make_aware(when, timezone.get_current_timezone())
+        return when
+
+    def _is_open(self, local):
+        time = local.time()
+        if self.start < self.end:
+            return self.start <= time < self.end
+        return time >= self.start or time < self.end
+
+    def is_open(self, when):
+        "Whether the window is open at the given time."
+        return self.start == self.end or self._is_open(self._to_local(when))
+
+    def next_open(self, when):
+        "The given time if the window is open or else the next time it opens."
+        if self.is_open(when):
+            return when
+        local = self._to_local(when)
+        opens = datetime.datetime.combine(local.date(), self.start)
+        if opens < local:
+            opens += datetime.timedelta(days=1)
+        return self._from_local(opens)
+
+    def closes(self, when):
+        "The time the window next closes after the given time."
+        local = self._to_local(when)
+        closes = datetime.datetime.combine(local.date(), self.end)
+        if closes <= local:
+            closes += datetime.timedelta(days=1)
+        return self._from_local(closes)
+
+    def get_slots(self, when):
+        "Start times of the slots left in the next window from the given time."
+        first = self.next_open(when)
+        last = self.closes(first)
+        slots = []
+        current = first
+        while current < last:
+            slots.append(current)
+            current += self.slot
+        return slots
+
+    def get_local_date(self, when):
+        "The date of the given time in the zone of the window."
+        return self._to_local(when).date()
+
+    def spread(self, count, when):
+        "Spread `count` messages evenly over the slots left in the next window."
+        slots = self.get_slots(when)
+        return [slots[i * len(slots) // count] for i in range(count)]
+
+
+def get_local_date(when):
+    "The date of the given time in the current time zone."
+    if timezone.is_aware(when):
+        when = timezone.localtime(when)
+    return when.date()
+
+
+def get_send_windows(windows, slot=15):
+    """
+    Build a SendWindow for each name mapped to a (start, end) pair or a
+    (start, end, zone) triple.
+    """
+    send_windows = {}
+    for name, window in windows.items():
+        start, end = window[:2]
+        zone = window[2] if len(window) > 2 else None
+        send_windows[name] = SendWindow(start, end, slot, zone)
+    return send_windows
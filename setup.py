@@ -38,5 +38,6 @@ setup(
     zip_safe=False,
     install_requires=[
         'Celery>=3.0',
+        'RapidSMS>=0.13.0',
     ]
 )